@@ -0,0 +1,43 @@
+{#
+    Change tracking for the incremental marts. The source tables have no updated_at
+    column, but every row version records the transaction that wrote it (xmin), and the
+    ELT script's merge and incremental modes only rewrite rows that changed. Each mart
+    row stores the oldest transaction still running when it was built (build_xid); the
+    next run redoes the source rows written by that transaction or any later one.
+#}
+
+{% macro row_xid(alias) -%}
+    {#- xmin is 32 bits and wraps around, so widen it against the snapshot's 64 bit xmax
+        (a scalar subquery, evaluated once per query rather than once per row). A row
+        older than a whole wraparound comes out too new: it is redone, never missed -#}
+    ((select pg_snapshot_xmax(pg_current_snapshot())::text::bigint)
+        - ((select pg_snapshot_xmax(pg_current_snapshot())::text::bigint)
+            - {{ alias }}.xmin::text::bigint) % 4294967296)
+{%- endmacro %}
+
+
+{% macro build_xid() -%}
+    {#- Transactions before this one had ended when the mart was built -#}
+    pg_snapshot_xmin(pg_current_snapshot())::text::bigint
+{%- endmacro %}
+
+
+{% macro last_build_xid() -%}
+    (select coalesce(max(build_xid), 0) from {{ this }})
+{%- endmacro %}
+
+
+{% macro delete_missing(source_relation, key_columns, source_key_columns=none) %}
+    {#- Post-hook: a deleted source row leaves no xmin behind, so drop its mart rows.
+        source_key_columns name the key in the source when it differs from the mart's -#}
+    delete from {{ this }} as built
+    where not exists (
+        select 1
+        from {{ source_relation }} as current_rows
+        where
+            {%- for column in key_columns %}
+            {% if not loop.first %}and {% endif -%}
+            current_rows.{{ (source_key_columns or key_columns)[loop.index0] }} = built.{{ column }}
+            {%- endfor %}
+    )
+{% endmacro %}
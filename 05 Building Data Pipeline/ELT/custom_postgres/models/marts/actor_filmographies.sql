@@ -0,0 +1,63 @@
+-- One row per actor and film they appear in, keyed like film_actors
+
+{{
+    config(
+        unique_key=['actor_id', 'film_id'],
+        indexes=[{'columns': ['actor_id', 'film_id'], 'unique': True}],
+        post_hook="{{ delete_missing(source('source_db', 'film_actors'), ['actor_id', 'film_id']) }}"
+    )
+}}
+
+with film_actors as (
+
+    select actor_id, film_id, {{ row_xid('fa') }} as row_xid
+    from {{ source('source_db', 'film_actors') }} as fa
+
+),
+
+actors as (
+
+    select actor_id, actor_name, {{ row_xid('a') }} as row_xid
+    from {{ source('source_db', 'actors') }} as a
+
+),
+
+films as (
+
+    select film_id, title, release_date, user_rating, {{ row_xid('f') }} as row_xid
+    from {{ source('source_db', 'films') }} as f
+
+),
+
+appearances as (
+
+    {% if is_incremental() %}
+    -- A renamed actor or retitled film changes every appearance it is part of
+    select actor_id, film_id from film_actors where row_xid >= {{ last_build_xid() }}
+    union
+    select film_actors.actor_id, film_actors.film_id
+    from film_actors
+    join actors using (actor_id)
+    where actors.row_xid >= {{ last_build_xid() }}
+    union
+    select film_actors.actor_id, film_actors.film_id
+    from film_actors
+    join films using (film_id)
+    where films.row_xid >= {{ last_build_xid() }}
+    {% else %}
+    select actor_id, film_id from film_actors
+    {% endif %}
+
+)
+
+select
+    appearances.actor_id,
+    actors.actor_name,
+    appearances.film_id,
+    films.title,
+    films.release_date,
+    films.user_rating,
+    {{ build_xid() }} as build_xid
+from appearances
+join actors using (actor_id)
+join films using (film_id)
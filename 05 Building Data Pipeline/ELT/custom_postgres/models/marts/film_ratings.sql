@@ -0,0 +1,72 @@
+-- One row per film with its rating and category list
+
+{{
+    config(
+        unique_key='film_id',
+        indexes=[{'columns': ['film_id'], 'unique': True}],
+        post_hook="{{ delete_missing(source('source_db', 'films'), ['film_id']) }}"
+    )
+}}
+
+with films as (
+
+    select film_id, title, release_date, rating, user_rating, {{ row_xid('f') }} as row_xid
+    from {{ source('source_db', 'films') }} as f
+
+),
+
+film_category as (
+
+    select category_id, film_id, category_name, {{ row_xid('fc') }} as row_xid
+    from {{ source('source_db', 'film_category') }} as fc
+
+),
+
+{% if is_incremental() %}
+
+changed_films as (
+
+    select film_id from films where row_xid >= {{ last_build_xid() }}
+    union
+    select film_id from film_category where row_xid >= {{ last_build_xid() }}
+    union
+    -- A removed category leaves no row behind; a count that no longer matches shows it
+    select built.film_id
+    from {{ this }} as built
+    left join (
+        select film_id, count(*) as category_count from film_category group by film_id
+    ) as current_counts using (film_id)
+    where built.category_count <> coalesce(current_counts.category_count, 0)
+
+),
+
+{% endif %}
+
+categories as (
+
+    select
+        film_id,
+        string_agg(category_name, ', ' order by category_name) as categories,
+        count(*) as category_count
+    from film_category
+    {% if is_incremental() %}
+    where film_id in (select film_id from changed_films)
+    {% endif %}
+    group by film_id
+
+)
+
+select
+    films.film_id,
+    films.title,
+    films.release_date,
+    films.rating,
+    films.user_rating,
+    categories.categories,
+    coalesce(categories.category_count, 0) as category_count,
+    {{ build_xid() }} as build_xid
+from films
+left join categories using (film_id)
+{% if is_incremental() %}
+where films.film_id in (select film_id from changed_films)
+{% endif %}
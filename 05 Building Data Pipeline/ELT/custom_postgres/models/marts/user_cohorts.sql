@@ -0,0 +1,36 @@
+-- One row per user with their birth cohorts; neither depends on the run date, so
+-- unchanged users never need redoing
+
+{{
+    config(
+        unique_key='user_id',
+        indexes=[{'columns': ['user_id'], 'unique': True}],
+        post_hook="{{ delete_missing(source('source_db', 'users'), ['user_id'], ['id']) }}"
+    )
+}}
+
+with users as (
+
+    select id as user_id, date_of_birth, {{ row_xid('u') }} as row_xid
+    from {{ source('source_db', 'users') }} as u
+
+)
+
+select
+    user_id,
+    date_of_birth,
+    (extract(year from date_of_birth)::int / 10 * 10)::text || 's' as birth_decade,
+    case
+        when date_of_birth is null then null
+        when date_of_birth < date '1946-01-01' then 'Silent Generation'
+        when date_of_birth < date '1965-01-01' then 'Baby Boomers'
+        when date_of_birth < date '1981-01-01' then 'Generation X'
+        when date_of_birth < date '1997-01-01' then 'Millennials'
+        when date_of_birth < date '2013-01-01' then 'Generation Z'
+        else 'Generation Alpha'
+    end as generation,
+    {{ build_xid() }} as build_xid
+from users
+{% if is_incremental() %}
+where row_xid >= {{ last_build_xid() }}
+{% endif %}
@@ -0,0 +1,150 @@
+import asyncio
+import random
+
+import psycopg2
+from psycopg2 import extensions
+
+# * Longest a single connection attempt may take; libpq only enforces connect_timeout
+# * itself on blocking connections
+CONNECT_TIMEOUT_SECONDS = 10
+
+
+async def wait_ready(connection):
+    """Drive a psycopg2 asynchronous connection until its current operation completes.
+
+    The event loop watches the socket instead of a thread blocking on it. If the waiting
+    task is cancelled, the running query is cancelled on the server as well.
+    """
+    loop = asyncio.get_running_loop()
+    fileno = connection.fileno()
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fileno, ready.set_result, None)
+            remove = loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fileno, ready.set_result, None)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"unexpected poll state {state}")
+        try:
+            await ready
+        except asyncio.CancelledError:
+            # ! Without this the server would keep running a query nobody waits for
+            if connection.isexecuting():
+                try:
+                    connection.cancel()
+                except psycopg2.Error:
+                    pass  # ^ still connecting: closing the connection is enough
+            raise
+        finally:
+            remove(fileno)
+
+
+async def connect(config):
+    """Open a non-blocking (always autocommit) connection."""
+    connection = psycopg2.connect(**config, async_=1)
+    try:
+        await asyncio.wait_for(wait_ready(connection), CONNECT_TIMEOUT_SECONDS)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+async def fetch(connection, query, params=None):
+    """Run one query on an asynchronous connection and return all of its rows."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        await wait_ready(connection)
+        return cursor.fetchall() if cursor.description else []
+    finally:
+        cursor.close()
+
+
+async def wait_until_ready(config, deadline, first_delay_seconds, max_delay_seconds):
+    """Probe one database until it answers SELECT 1 or the loop clock passes deadline."""
+    loop = asyncio.get_running_loop()
+    delay, attempt = first_delay_seconds, 0
+    while True:
+        attempt += 1
+        try:
+            connection = await connect(config)
+            try:
+                await fetch(connection, "SELECT 1")
+            finally:
+                connection.close()
+            print(f"Successfully connected to PostgreSQL at {config['host']}!")
+            return True
+        except (psycopg2.OperationalError, asyncio.TimeoutError) as e:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                print(f"Giving up on {config['host']} after {attempt} attempts: {e}")
+                return False
+            await asyncio.sleep(min(random.uniform(0, delay), remaining))
+            delay = min(delay * 2, max_delay_seconds)
+
+
+class ConnectionPool:
+    """A fixed set of asynchronous connections to one database.
+
+    The pool size is that database's concurrency limit: acquire() waits (like a
+    semaphore) until one of its connections is free.
+    """
+
+    def __init__(self, config, size, session_settings=()):
+        self.config = config
+        self.size = max(1, size)
+        self.session_settings = session_settings
+        self._idle = asyncio.Queue()
+        self._all = []
+
+    async def open(self):
+        async def open_one():
+            connection = await connect(self.config)
+            self._all.append(connection)
+            for name, value in self.session_settings:
+                await fetch(connection, "SELECT set_config(%s, %s, false)", (name, value))
+            self._idle.put_nowait(connection)
+
+        await gather_or_cancel([open_one() for _ in range(self.size)])
+        return self
+
+    async def fetch(self, query, params=None):
+        connection = await self._idle.get()
+        try:
+            return await fetch(connection, query, params)
+        finally:
+            self._idle.put_nowait(connection)
+
+    def close(self):
+        for connection in self._all:
+            connection.close()
+
+
+async def gather_or_cancel(awaitables):
+    """Run awaitables concurrently; the first failure cancels all the others and is raised.
+
+    Returns the results in order, like asyncio.gather, but never leaves siblings of a
+    failed task running in the background.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # ^ Also reached when this coroutine itself is cancelled
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    for task in tasks:
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from elt_script import destination_config, source_config
+
+# * Transfer modes compared by default; cdc is left out because it keeps running
+DEFAULT_MODES = ["dump", "stream", "parallel", "copy", "copy --fast-load", "incremental"]
+
+
+def source_totals(config):
+    """Exact row counts per table and their total on-disk size in bytes."""
+    connection = psycopg2.connect(**config)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT n.nspname, c.relname, pg_table_size(c.oid)
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.relkind = 'r'
+                  AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                  AND n.nspname NOT LIKE 'pg_toast%%'
+                """
+            )
+            tables = cursor.fetchall()
+            counts, size = {}, 0
+            for schema, table, table_size in tables:
+                cursor.execute(
+                    sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(schema, table))
+                )
+                counts[f"{schema}.{table}"] = cursor.fetchone()[0]
+                size += table_size
+        return counts, size
+    finally:
+        connection.close()
+
+
+def recreate_destination(config):
+    """Drop and recreate the destination database so every mode starts from empty."""
+    connection = psycopg2.connect(**dict(config, dbname="postgres"))
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            name = sql.Identifier(config["dbname"])
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(name))
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(name))
+    finally:
+        connection.close()
+
+
+def run_mode(mode, extra_args):
+    """Run elt_script.py in one mode; returns (wall seconds, peak RSS in MB)."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "elt_script.py")
+    command = [sys.executable, script, "--mode", *shlex.split(mode), *extra_args]
+    started = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # ^ wait4 gives the resource usage of this one run, not of every child so far
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - started
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    # ^ ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time each transfer mode from source_db into an empty destination_db."
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=DEFAULT_MODES,
+        help='modes to compare; quote modes with options, e.g. "copy --fast-load"',
+    )
+    parser.add_argument(
+        "--extra-args",
+        default="",
+        help='options passed to every run, e.g. "--jobs 8"',
+    )
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    counts, size = source_totals(source_config)
+    rows = sum(counts.values())
+    print(f"Source: {rows} rows in {len(counts)} tables, {size / 1e6:.1f} MB")
+
+    results = []
+    for mode in args.modes:
+        recreate_destination(destination_config)
+        elapsed, peak_mb = run_mode(mode, shlex.split(args.extra_args))
+        copied, _ = source_totals(destination_config)
+        result = {
+            "mode": mode,
+            "wall_seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed),
+            "mb_per_second": round(size / 1e6 / elapsed, 2),
+            "peak_rss_mb": round(peak_mb, 1),
+            # ^ a mode that drops rows must not look fast
+            "rows_match": all(copied.get(table) == count for table, count in counts.items()),
+        }
+        results.append(result)
+        print(
+            f"{mode:<20} {elapsed:8.2f}s {result['rows_per_second']:>12} rows/s "
+            f"{result['mb_per_second']:>8} MB/s {result['peak_rss_mb']:>8} MB peak "
+            f"{'ok' if result['rows_match'] else 'ROW COUNT MISMATCH'}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as report:
+            json.dump({"source_rows": rows, "source_bytes": size, "results": results}, report, indent=2)
+
+
+if __name__ == "__main__":
+    main()
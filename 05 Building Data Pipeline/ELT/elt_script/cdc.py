@@ -0,0 +1,330 @@
+import struct
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+import copy_engine
+from incremental import STATE_SCHEMA
+
+# * Names of the replication objects created on the source
+SLOT_NAME = "elt_cdc"
+PUBLICATION_NAME = "elt_cdc"
+
+# * Confirmed LSNs live on the destination, committed together with the changes they cover
+PROGRESS_TABLE = "cdc_progress"
+
+
+def lsn_to_int(lsn):
+    """Turn a textual LSN like '0/16B3748' into a comparable integer."""
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class PgOutputMessage:
+    """Cursor over one binary pgoutput (protocol version 1) message."""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.offset = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values[0] if len(values) == 1 else values
+
+    def read_string(self):
+        end = self.data.index(b"\0", self.offset)
+        value = self.data[self.offset:end].decode()
+        self.offset = end + 1
+        return value
+
+    def read_tuple(self):
+        """Return column values as text; None for NULL, and UNCHANGED for unchanged TOAST values."""
+        values = []
+        for _ in range(self.read("!h")):
+            kind = self.read("!c")
+            if kind == b"n":
+                values.append(None)
+            elif kind == b"u":
+                values.append(UNCHANGED)
+            else:
+                length = self.read("!i")
+                values.append(self.data[self.offset:self.offset + length].decode())
+                self.offset += length
+        return values
+
+
+# ^ Marker for a TOASTed column the update did not touch; it is left out of the SET list
+UNCHANGED = object()
+
+
+def decode(data, relations):
+    """Decode one pgoutput message into (kind, ...) and keep the relation map up to date."""
+    message = PgOutputMessage(data)
+    kind = message.read("!c")
+
+    if kind == b"R":
+        oid = message.read("!I")
+        schema, table = message.read_string(), message.read_string()
+        message.read("!b")  # ^ replica identity setting
+        columns = []
+        for _ in range(message.read("!h")):
+            flags = message.read("!b")
+            name = message.read_string()
+            message.read("!Ii")  # ^ type oid and modifier; values arrive as text anyway
+            columns.append((name, bool(flags & 1)))
+        relations[oid] = (schema, table, columns)
+        return ("relation",)
+    if kind == b"B":
+        return ("begin",)
+    if kind == b"C":
+        return ("commit",)
+    if kind == b"I":
+        oid = message.read("!I")
+        message.read("!c")  # ^ 'N'
+        return ("insert", relations[oid], message.read_tuple())
+    if kind == b"U":
+        oid = message.read("!I")
+        old = None
+        marker = message.read("!c")
+        if marker in (b"K", b"O"):
+            old = message.read_tuple()
+            message.read("!c")  # ^ 'N'
+        return ("update", relations[oid], old, message.read_tuple())
+    if kind == b"D":
+        oid = message.read("!I")
+        message.read("!c")  # ^ 'K' or 'O'
+        return ("delete", relations[oid], message.read_tuple())
+    if kind == b"T":
+        count = message.read("!i")
+        message.read("!b")  # ^ CASCADE / RESTART IDENTITY flags
+        return ("truncate", [relations[message.read("!I")] for _ in range(count)])
+    return ("ignored",)  # ^ origin and type messages carry nothing we need
+
+
+def key_values(relation, values):
+    schema, table, columns = relation
+    pairs = [(name, value) for (name, is_key), value in zip(columns, values) if is_key]
+    if not pairs:
+        raise ValueError(f"{schema}.{table} has no replica identity key to apply changes by")
+    return pairs
+
+
+def where_clause(pairs):
+    return sql.SQL(" AND ").join(
+        sql.SQL("{} = %s").format(sql.Identifier(name)) for name, _ in pairs
+    )
+
+
+def apply_change(cursor, change):
+    """Apply one decoded row change to the destination.
+
+    Inserts are upserts on the key, so replaying changes already covered by the initial
+    copy (or by a batch whose slot advance was lost) converges to the same rows.
+    """
+    kind = change[0]
+
+    if kind == "insert":
+        (schema, table, columns), values = change[1], change[2]
+        names = [sql.Identifier(name) for name, _ in columns]
+        keys = [sql.Identifier(name) for name, is_key in columns if is_key]
+        others = [sql.Identifier(name) for name, is_key in columns if not is_key]
+        statement = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+            sql.Identifier(schema, table),
+            sql.SQL(", ").join(names),
+            sql.SQL(", ").join(sql.Placeholder() * len(names)),
+        )
+        if keys:
+            statement += sql.SQL(" ON CONFLICT ({}) DO ").format(sql.SQL(", ").join(keys))
+            if others:
+                statement += sql.SQL("UPDATE SET {}").format(
+                    sql.SQL(", ").join(
+                        sql.SQL("{0} = EXCLUDED.{0}").format(name) for name in others
+                    )
+                )
+            else:
+                statement += sql.SQL("NOTHING")
+        cursor.execute(statement, values)
+
+    elif kind == "update":
+        (schema, table, columns), old, new = change[1], change[2], change[3]
+        key = key_values(change[1], old if old is not None else new)
+        assignments = [
+            (name, value) for (name, _), value in zip(columns, new) if value is not UNCHANGED
+        ]
+        cursor.execute(
+            sql.SQL("UPDATE {} SET {} WHERE {}").format(
+                sql.Identifier(schema, table),
+                sql.SQL(", ").join(
+                    sql.SQL("{} = %s").format(sql.Identifier(name)) for name, _ in assignments
+                ),
+                where_clause(key),
+            ),
+            [value for _, value in assignments] + [value for _, value in key],
+        )
+
+    elif kind == "delete":
+        (schema, table, columns), old = change[1], change[2]
+        key = key_values(change[1], old)
+        cursor.execute(
+            sql.SQL("DELETE FROM {} WHERE {}").format(
+                sql.Identifier(schema, table), where_clause(key)
+            ),
+            [value for _, value in key],
+        )
+
+    elif kind == "truncate":
+        cursor.execute(
+            sql.SQL("TRUNCATE {}").format(
+                sql.SQL(", ").join(
+                    sql.Identifier(schema, table) for schema, table, _ in change[1]
+                )
+            )
+        )
+
+
+def ensure_slot(source_config):
+    """Create the publication and logical replication slot on the source; True if the slot is new.
+
+    The source must run with wal_level=logical. A FOR ALL TABLES publication makes Postgres
+    reject UPDATE/DELETE on tables without a primary key or replica identity.
+    """
+    source_connection = psycopg2.connect(**source_config)
+    source_connection.autocommit = True
+    try:
+        return create_replication_objects(source_connection)
+    finally:
+        source_connection.close()
+
+
+def create_replication_objects(source_connection):
+    with source_connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_publication WHERE pubname = %s", (PUBLICATION_NAME,))
+        if cursor.fetchone() is None:
+            cursor.execute(
+                sql.SQL("CREATE PUBLICATION {} FOR ALL TABLES").format(
+                    sql.Identifier(PUBLICATION_NAME)
+                )
+            )
+        cursor.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (SLOT_NAME,))
+        if cursor.fetchone() is not None:
+            return False
+        cursor.execute(
+            "SELECT pg_create_logical_replication_slot(%s, 'pgoutput')", (SLOT_NAME,)
+        )
+        return True
+
+
+def ensure_progress_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+                CREATE SCHEMA IF NOT EXISTS {schema};
+                CREATE TABLE IF NOT EXISTS {table} (
+                    slot_name TEXT PRIMARY KEY,
+                    confirmed_lsn PG_LSN NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            ).format(
+                schema=sql.Identifier(STATE_SCHEMA),
+                table=sql.Identifier(STATE_SCHEMA, PROGRESS_TABLE),
+            )
+        )
+    connection.commit()
+
+
+def confirmed_lsn(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT confirmed_lsn::text FROM {} WHERE slot_name = %s").format(
+                sql.Identifier(STATE_SCHEMA, PROGRESS_TABLE)
+            ),
+            (SLOT_NAME,),
+        )
+        row = cursor.fetchone()
+    connection.commit()
+    return row[0] if row else None
+
+
+def apply_batch(source_connection, destination_connection, batch_size):
+    """Apply the next batch of committed source transactions; returns how many were consumed."""
+    with source_connection.cursor() as cursor:
+        # ^ peek does not consume anything; the slot only moves once the destination has committed
+        cursor.execute(
+            "SELECT lsn::text, data FROM pg_logical_slot_peek_binary_changes("
+            "%s, NULL, %s, 'proto_version', '1', 'publication_names', %s)",
+            (SLOT_NAME, batch_size, PUBLICATION_NAME),
+        )
+        messages = cursor.fetchall()
+    if not messages:
+        return 0
+
+    already_applied = confirmed_lsn(destination_connection)
+    already_applied = lsn_to_int(already_applied) if already_applied else -1
+
+    relations, transaction, applied, transactions, last_lsn = {}, [], 0, 0, None
+    with destination_connection.cursor() as cursor:
+        for lsn, data in messages:
+            change = decode(data, relations)
+            if change[0] == "begin":
+                transaction = []
+            elif change[0] == "commit":
+                # ! A batch that was applied but whose slot advance was lost is skipped here
+                if lsn_to_int(lsn) > already_applied:
+                    for row_change in transaction:
+                        apply_change(cursor, row_change)
+                    applied += len(transaction)
+                transactions += 1
+                last_lsn = lsn
+            elif change[0] == "truncate":
+                # ^ Tables left out by the table filter are not on the destination
+                tables = [
+                    relation for relation in change[1] if copy_engine.table_selected(*relation[:2])
+                ]
+                if tables:
+                    transaction.append(("truncate", tables))
+            elif change[0] not in ("relation", "ignored"):
+                if copy_engine.table_selected(*change[1][:2]):
+                    transaction.append(change)
+
+        if last_lsn is None:
+            return 0
+        cursor.execute(
+            sql.SQL(
+                """
+                INSERT INTO {} (slot_name, confirmed_lsn) VALUES (%s, %s)
+                ON CONFLICT (slot_name) DO UPDATE
+                SET confirmed_lsn = EXCLUDED.confirmed_lsn, updated_at = now()
+                """
+            ).format(sql.Identifier(STATE_SCHEMA, PROGRESS_TABLE)),
+            (SLOT_NAME, last_lsn),
+        )
+    destination_connection.commit()
+
+    with source_connection.cursor() as cursor:
+        cursor.execute("SELECT pg_replication_slot_advance(%s, %s)", (SLOT_NAME, last_lsn))
+    print(f"Applied {applied} changes up to LSN {last_lsn}")
+    return transactions
+
+
+def stream_changes(source_config, destination_config, batch_size, poll_seconds):
+    """Apply source changes to the destination until interrupted; drain once if poll_seconds is 0."""
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    source_connection.autocommit = True
+    try:
+        ensure_progress_table(destination_connection)
+        while True:
+            while apply_batch(source_connection, destination_connection, batch_size):
+                pass
+            if poll_seconds <= 0:
+                return
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print("Stopping change data capture")
+    finally:
+        source_connection.close()
+        destination_connection.close()
@@ -0,0 +1,196 @@
+import psycopg2
+from psycopg2 import sql
+
+import incremental
+
+RUN_TABLE = "copy_runs"
+CHECKPOINT_TABLE = "copy_checkpoints"
+PLAN_TABLE = "copy_chunk_plans"
+
+# * Chunk number recorded once a whole table is published; its chunks are numbered from 1
+TABLE_DONE = 0
+
+
+def ensure_checkpoint_tables(connection):
+    """Create the copy run and checkpoint state tables on the destination if they are missing."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+                CREATE SCHEMA IF NOT EXISTS {schema};
+                CREATE TABLE IF NOT EXISTS {runs} (
+                    run_id BIGSERIAL PRIMARY KEY,
+                    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    data_loaded_at TIMESTAMPTZ,
+                    finished_at TIMESTAMPTZ
+                );
+                CREATE TABLE IF NOT EXISTS {checkpoints} (
+                    run_id BIGINT NOT NULL REFERENCES {runs} ON DELETE CASCADE,
+                    table_schema TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    chunk INTEGER NOT NULL,
+                    rows BIGINT NOT NULL,
+                    bytes BIGINT NOT NULL,
+                    committed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (run_id, table_schema, table_name, chunk)
+                );
+                CREATE TABLE IF NOT EXISTS {plans} (
+                    run_id BIGINT NOT NULL REFERENCES {runs} ON DELETE CASCADE,
+                    table_schema TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    key_column TEXT NOT NULL,
+                    points TEXT[] NOT NULL,
+                    PRIMARY KEY (run_id, table_schema, table_name)
+                )
+                """
+            ).format(
+                schema=sql.Identifier(incremental.STATE_SCHEMA),
+                runs=sql.Identifier(incremental.STATE_SCHEMA, RUN_TABLE),
+                checkpoints=sql.Identifier(incremental.STATE_SCHEMA, CHECKPOINT_TABLE),
+                plans=sql.Identifier(incremental.STATE_SCHEMA, PLAN_TABLE),
+            )
+        )
+    connection.commit()
+
+
+def unfinished_run(destination_config):
+    """Return (run_id, data_loaded) of the latest copy run that never finished, or None."""
+    connection = psycopg2.connect(**destination_config)
+    try:
+        ensure_checkpoint_tables(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    "SELECT run_id, data_loaded_at IS NOT NULL FROM {}"
+                    " WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1"
+                ).format(sql.Identifier(incremental.STATE_SCHEMA, RUN_TABLE))
+            )
+            return cursor.fetchone()
+    finally:
+        connection.close()
+
+
+def start_run(destination_config):
+    """Register a new copy run, abandoning any unfinished one, and return its id."""
+    connection = psycopg2.connect(**destination_config)
+    try:
+        ensure_checkpoint_tables(connection)
+        with connection.cursor() as cursor:
+            # ^ Checkpoints of an abandoned run describe data that is about to be replaced
+            cursor.execute(
+                sql.SQL("DELETE FROM {} WHERE finished_at IS NULL").format(
+                    sql.Identifier(incremental.STATE_SCHEMA, RUN_TABLE)
+                )
+            )
+            cursor.execute(
+                sql.SQL("INSERT INTO {} DEFAULT VALUES RETURNING run_id").format(
+                    sql.Identifier(incremental.STATE_SCHEMA, RUN_TABLE)
+                )
+            )
+            run_id = cursor.fetchone()[0]
+        connection.commit()
+        return run_id
+    finally:
+        connection.close()
+
+
+def _set_run_time(destination_config, run_id, column):
+    connection = psycopg2.connect(**destination_config)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("UPDATE {} SET {} = now() WHERE run_id = %s").format(
+                    sql.Identifier(incremental.STATE_SCHEMA, RUN_TABLE), sql.Identifier(column)
+                ),
+                (run_id,),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def mark_data_loaded(destination_config, run_id):
+    _set_run_time(destination_config, run_id, "data_loaded_at")
+
+
+def finish_run(destination_config, run_id):
+    """Mark the run finished and drop its checkpoints, which only matter while it can resume."""
+    _set_run_time(destination_config, run_id, "finished_at")
+    connection = psycopg2.connect(**destination_config)
+    try:
+        with connection.cursor() as cursor:
+            for table in (CHECKPOINT_TABLE, PLAN_TABLE):
+                cursor.execute(
+                    sql.SQL("DELETE FROM {} WHERE run_id = %s").format(
+                        sql.Identifier(incremental.STATE_SCHEMA, table)
+                    ),
+                    (run_id,),
+                )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def completed(connection, run_id):
+    """Return {(schema, table, chunk): (rows, bytes)} for everything the run has committed."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "SELECT table_schema, table_name, chunk, rows, bytes FROM {} WHERE run_id = %s"
+            ).format(sql.Identifier(incremental.STATE_SCHEMA, CHECKPOINT_TABLE)),
+            (run_id,),
+        )
+        rows = cursor.fetchall()
+    connection.commit()
+    return {(schema, table, chunk): (count, size) for schema, table, chunk, count, size in rows}
+
+
+def record(connection, run_id, schema, table, chunk, rows, size):
+    """Record a committed table or chunk; call inside the transaction that wrote its rows."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {} (run_id, table_schema, table_name, chunk, rows, bytes)"
+                " VALUES (%s, %s, %s, %s, %s, %s)"
+            ).format(sql.Identifier(incremental.STATE_SCHEMA, CHECKPOINT_TABLE)),
+            (run_id, schema, table, chunk, rows, size),
+        )
+
+
+def forget_chunks(connection, run_id, schema, table):
+    """Drop the chunk checkpoints of one table, e.g. when its staging rows were lost."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "DELETE FROM {} WHERE run_id = %s AND table_schema = %s AND table_name = %s"
+            ).format(sql.Identifier(incremental.STATE_SCHEMA, CHECKPOINT_TABLE)),
+            (run_id, schema, table),
+        )
+
+
+def chunk_plan(connection, run_id, schema, table):
+    """Return the (column, points) stored for the table by this run, or None."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "SELECT key_column, points FROM {}"
+                " WHERE run_id = %s AND table_schema = %s AND table_name = %s"
+            ).format(sql.Identifier(incremental.STATE_SCHEMA, PLAN_TABLE)),
+            (run_id, schema, table),
+        )
+        row = cursor.fetchone()
+    connection.commit()
+    return row
+
+
+def save_chunk_plan(connection, run_id, schema, table, column, points):
+    """Store the split points so a resumed run cuts the table into the same chunks."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {} (run_id, table_schema, table_name, key_column, points)"
+                " VALUES (%s, %s, %s, %s, %s)"
+            ).format(sql.Identifier(incremental.STATE_SCHEMA, PLAN_TABLE)),
+            (run_id, schema, table, column, list(points)),
+        )
+    connection.commit()
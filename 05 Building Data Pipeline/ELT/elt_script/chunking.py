@@ -0,0 +1,240 @@
+import math
+import time
+from concurrent.futures import wait
+
+from psycopg2 import sql
+
+import checkpoints
+import copy_engine
+import pushdown
+import verify
+
+# * Staging tables for chunked copies are named with this prefix next to their target
+STAGING_PREFIX = "_elt_chunks_"
+
+
+def leading_key_column(connection, schema, table):
+    """Return (column, type) of the first primary key column, or None if the table has no key."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = con.conkey[1]
+            WHERE con.contype = 'p' AND n.nspname = %s AND c.relname = %s
+            """,
+            (schema, table),
+        )
+        return cursor.fetchone()
+
+
+def plan_chunks(connection, schema, table, rows_per_chunk):
+    """Split a table into ranges of its leading primary key column, about rows_per_chunk rows each.
+
+    Returns (column, [split points]); an empty list means the table is copied in one piece.
+    Ranges only use the leading column, so composite keys like film_actors(film_id,
+    actor_id) split on film_id.
+    """
+    key = leading_key_column(connection, schema, table)
+    if key is None:
+        return None, []
+    column, column_type = key
+
+    with connection.cursor() as cursor:
+        # ^ reltuples is the planner's row estimate; -1 (never analyzed) counts as small
+        cursor.execute(
+            "SELECT greatest(reltuples, 0)::bigint FROM pg_class WHERE oid = %s::regclass",
+            (sql.Identifier(schema, table).as_string(cursor),),
+        )
+        estimated_rows = cursor.fetchone()[0]
+        chunk_count = math.ceil(estimated_rows / rows_per_chunk)
+        if chunk_count <= 1:
+            return column, []
+
+        # * The column histogram has buckets of roughly equal row counts, so its bounds
+        # * make evenly sized chunks even when the key values are skewed
+        cursor.execute(
+            """
+            SELECT histogram_bounds::text::text[]
+            FROM pg_stats
+            WHERE schemaname = %s AND tablename = %s AND attname = %s
+            """,
+            (schema, table, column),
+        )
+        row = cursor.fetchone()
+        bounds = row[0] if row and row[0] else None
+        if bounds and len(bounds) > 2:
+            buckets = len(bounds) - 1
+            chunk_count = min(chunk_count, buckets)
+            points = [bounds[round(i * buckets / chunk_count)] for i in range(1, chunk_count)]
+            return column, list(dict.fromkeys(points))
+
+        # ^ No histogram yet: fall back to an even split of the key range for integer keys
+        if column_type not in ("smallint", "integer", "bigint"):
+            return column, []
+        cursor.execute(
+            sql.SQL("SELECT min({c}), max({c}) FROM {t}").format(
+                c=sql.Identifier(column), t=sql.Identifier(schema, table)
+            )
+        )
+        low, high = cursor.fetchone()
+        if low is None or high <= low:
+            return column, []
+        step = (high - low + 1) / chunk_count
+        points = [str(low + math.ceil(i * step)) for i in range(1, chunk_count)]
+        return column, list(dict.fromkeys(points))
+
+
+def chunk_conditions(column, points):
+    """Build one WHERE condition per key range; the first and last ranges are open-ended."""
+    key = sql.Identifier(column)
+    edges = [None] + list(points) + [None]
+    conditions = []
+    for lower, upper in zip(edges, edges[1:]):
+        bounds = []
+        if lower is not None:
+            bounds.append(sql.SQL("{} >= {}").format(key, sql.Literal(lower)))
+        if upper is not None:
+            bounds.append(sql.SQL("{} < {}").format(key, sql.Literal(upper)))
+        conditions.append(sql.SQL(" AND ").join(bounds))
+    return conditions
+
+
+def chunk_queries(schema, table, column, points):
+    """Build one SELECT per key range of the table, with its pushdown columns and filter."""
+    return [
+        pushdown.select(schema, table, condition) for condition in chunk_conditions(column, points)
+    ]
+
+
+def copy_table_in_chunks(workers, chunk_pool, schema, table, column, points, run_id=None, done=None):
+    """Copy key ranges concurrently into an UNLOGGED staging table, then publish them in one transaction.
+
+    Readers of the destination see either none of the table's rows or all of them. With a
+    run_id every chunk is checkpointed as it commits, and chunks listed in done (from
+    checkpoints.completed) are not copied again.
+    """
+    started = time.monotonic()
+    staging = STAGING_PREFIX + table
+    staging_name = sql.Identifier(schema, staging)
+    source_connection, destination_connection = workers.get()
+    done = {
+        chunk: counts
+        for (done_schema, done_table, chunk), counts in (done or {}).items()
+        if (done_schema, done_table) == (schema, table)
+    }
+
+    with destination_connection.cursor() as cursor:
+        if done:
+            # ! UNLOGGED tables are emptied by crash recovery, so trust the checkpoints only
+            # ! while the staging table still holds every row they account for
+            cursor.execute("SELECT to_regclass(%s)", (staging_name.as_string(cursor),))
+            staged = None
+            if cursor.fetchone()[0] is not None:
+                cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(staging_name))
+                staged = cursor.fetchone()[0]
+            if staged != sum(rows for rows, _ in done.values()):
+                print(f"Staged chunks of {schema}.{table} were lost, copying them again")
+                checkpoints.forget_chunks(destination_connection, run_id, schema, table)
+                done = {}
+        if not done:
+            cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(staging_name))
+            cursor.execute(
+                sql.SQL("CREATE UNLOGGED TABLE {} (LIKE {})").format(
+                    staging_name, sql.Identifier(schema, table)
+                )
+            )
+    destination_connection.commit()
+
+    queries = chunk_queries(schema, table, column, points)
+
+    def copy_chunk(number, query):
+        def step():
+            chunk_source, chunk_destination = workers.get()
+            rows, size = copy_engine.copy_table(
+                chunk_source, chunk_destination, schema, staging, query, source_table=table
+            )
+            if run_id is not None:
+                checkpoints.record(chunk_destination, run_id, schema, table, number, rows, size)
+            return rows, size
+
+        return copy_engine.run_with_retries(
+            *workers.get(), f"{schema}.{table} chunk {number}/{len(queries)}", step
+        )
+
+    futures = [
+        chunk_pool.submit(copy_chunk, number, query)
+        for number, query in enumerate(queries, start=1)
+        if number not in done
+    ]
+    if done:
+        print(f"Resuming {schema}.{table}: {len(done)} of {len(queries)} chunks already staged")
+    wait(futures)
+    rows = sum(chunk_rows for chunk_rows, _ in done.values())
+    size = sum(chunk_size for _, chunk_size in done.values())
+    for future in futures:
+        chunk_rows, chunk_size = future.result()  # ^ re-raises the first failed chunk
+        rows += chunk_rows
+        size += chunk_size
+
+    # ^ LIKE turns generated columns into plain ones, so name the insertable columns
+    columns = verify.table_columns(destination_connection, schema, table)
+    column_list = sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+    with destination_connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                sql.Identifier(schema, table), column_list, column_list, staging_name
+            )
+        )
+        cursor.execute(sql.SQL("DROP TABLE {}").format(staging_name))
+    if run_id is not None:
+        checkpoints.record(
+            destination_connection, run_id, schema, table, checkpoints.TABLE_DONE, rows, size
+        )
+    destination_connection.commit()
+    print(
+        f"Copied {schema}.{table}: {rows} rows, {size} bytes in {len(queries)} chunks"
+        f" in {time.monotonic() - started:.2f}s"
+    )
+    return rows, size
+
+
+def copy_into_staging(workers, chunk_pool, schema, table, staging, chunk_rows=None):
+    """Copy a source table into another destination table, in parallel key ranges when it is big.
+
+    The staging table must have no keys, so the ranges can load side by side; each range
+    commits on its own. Returns (rows, bytes).
+    """
+    column, points = None, []
+    if chunk_rows:
+        column, points = plan_chunks(workers.get()[0], schema, table, chunk_rows)
+    if points:
+        queries = chunk_queries(schema, table, column, points)
+    else:
+        queries = [pushdown.select(schema, table)]
+
+    def copy_part(number, query):
+        def step():
+            part_source, part_destination = workers.get()
+            return copy_engine.copy_table(
+                part_source, part_destination, schema, staging, query, source_table=table
+            )
+
+        label = f"{schema}.{table}"
+        if len(queries) > 1:
+            label += f" chunk {number}/{len(queries)}"
+        return copy_engine.run_with_retries(*workers.get(), label, step)
+
+    futures = [
+        chunk_pool.submit(copy_part, number, query)
+        for number, query in enumerate(queries, start=1)
+    ]
+    wait(futures)
+    rows = size = 0
+    for future in futures:
+        part_rows, part_size = future.result()  # ^ re-raises the first failed chunk
+        rows += part_rows
+        size += part_size
+    return rows, size
@@ -0,0 +1,92 @@
+import gzip
+import re
+import subprocess
+
+# * Supported codecs and the suffix their spool files get
+EXTENSIONS = {"none": "", "gzip": ".gz", "lz4": ".lz4", "zstd": ".zst"}
+
+# * Levels used when none is given: fast settings that still shrink SQL text several times
+DEFAULT_LEVELS = {"gzip": 1, "lz4": 1, "zstd": 3}
+
+
+def extension(codec):
+    return EXTENSIONS[codec or "none"]
+
+
+def _require(module_name, package):
+    try:
+        return __import__(module_name, fromlist=["_"])
+    except ImportError:
+        raise RuntimeError(
+            f"{module_name} compression needs the {package} package (pip install {package})"
+        ) from None
+
+
+def open_writer(path, codec, level=None, threads=0):
+    """Open path for writing binary data compressed with codec.
+
+    threads only applies to zstd, which compresses on that many extra threads (-1 means one
+    per CPU); lz4 and gzip always compress on the calling thread.
+    """
+    codec = codec or "none"
+    if level is None:
+        level = DEFAULT_LEVELS.get(codec)
+    if codec == "none":
+        return open(path, "wb")
+    if codec == "gzip":
+        return gzip.open(path, "wb", compresslevel=level)
+    if codec == "lz4":
+        lz4_frame = _require("lz4.frame", "lz4")
+        return lz4_frame.open(path, "wb", compression_level=level)
+    if codec == "zstd":
+        zstandard = _require("zstandard", "zstandard")
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(open(path, "wb"), closefd=True)
+    raise ValueError(f"unknown compression codec {codec!r}")
+
+
+def open_reader(path, codec):
+    """Open a file written by open_writer for reading the decompressed bytes."""
+    codec = codec or "none"
+    if codec == "none":
+        return open(path, "rb")
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "lz4":
+        return _require("lz4.frame", "lz4").open(path, "rb")
+    if codec == "zstd":
+        decompressor = _require("zstandard", "zstandard").ZstdDecompressor()
+        return decompressor.stream_reader(open(path, "rb"), closefd=True)
+    raise ValueError(f"unknown compression codec {codec!r}")
+
+
+# * The first pg_dump release that takes -Z lz4:N and -Z zstd:N
+PG_DUMP_CODECS_VERSION = 16
+
+
+def check_pg_dump(codec):
+    """Fail before a run starts if the installed pg_dump cannot compress with codec."""
+    if codec not in ("lz4", "zstd"):
+        return
+    output = subprocess.run(
+        ["pg_dump", "--version"], check=True, capture_output=True, text=True
+    ).stdout
+    version = re.search(r"(\d+)", output)
+    if version is None or int(version.group(1)) < PG_DUMP_CODECS_VERSION:
+        raise ValueError(
+            f"parallel mode with {codec} compression needs pg_dump {PG_DUMP_CODECS_VERSION} "
+            f"or later, but found {output.strip()!r}; use gzip or none"
+        )
+
+
+def pg_dump_options(codec, level=None):
+    """pg_dump options that compress an archive (-Fd/-Fc) with codec; lz4 and zstd need pg_dump 16+."""
+    if codec is None:
+        return []  # ^ keep pg_dump's own default
+    if codec == "none":
+        return ["-Z", "0"]
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == "gzip":
+        return ["-Z", str(level)]
+    return ["-Z", f"{codec}:{level}"]
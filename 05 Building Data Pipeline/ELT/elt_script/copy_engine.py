@@ -0,0 +1,410 @@
+import fnmatch
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import errors, extensions, sql
+
+import checkpoints
+import chunking
+import metrics
+import pushdown
+import scheduler
+import streaming
+import table_cache
+import transforms
+
+# * Data moves between the two COPY streams in chunks of this size
+CHUNK_BYTES = 1024 * 1024
+
+# * At most this many chunks wait in memory before the source side blocks
+MAX_BUFFERED_CHUNKS = 8
+
+# * How many times a single table is attempted before the run gives up
+TABLE_RETRIES = 3
+RETRY_DELAY_SECONDS = 2
+
+# * Tables this process is limited to, as patterns on "schema.table" (a pattern without a
+# * dot matches the bare table name); an empty include list means every table
+TABLE_FILTER = {"include": [], "exclude": []}
+
+
+class BoundedPipe:
+    """In-memory file-like buffer between a COPY TO STDOUT and a COPY FROM STDIN."""
+
+    def __init__(self, chunk_bytes=CHUNK_BYTES, max_chunks=MAX_BUFFERED_CHUNKS):
+        self.chunk_bytes = chunk_bytes
+        self.bytes = 0
+        self._queue = queue.Queue(max_chunks)
+        self._pending = bytearray()
+        self._current = b""
+        self._eof = False
+        self._error = None
+        self._aborted = threading.Event()
+
+    # ^ Writer side: psycopg2 calls write() once per row, so rows are batched into chunks
+    def write(self, data):
+        self._pending += data
+        self.bytes += len(data)
+        if len(self._pending) >= self.chunk_bytes:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        return len(data)
+
+    def _put(self, item):
+        while True:
+            if self._aborted.is_set():
+                raise RuntimeError("COPY reader aborted")
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, error=None):
+        """Flush what is left and signal end of data (or the writer's error) to the reader."""
+        self._error = error
+        if self._pending and error is None:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        self._put(None)
+
+    def abort(self):
+        """Unblock the writer when the reader side has failed."""
+        self._aborted.set()
+
+    # ^ Reader side: psycopg2 calls read(size) until it gets an empty result
+    def read(self, size=-1):
+        while not self._current and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+            else:
+                self._current = item
+        if size is None or size < 0:
+            data, self._current = self._current, b""
+        else:
+            data, self._current = self._current[:size], self._current[size:]
+        return data
+
+
+class WorkerConnections:
+    """One source/destination connection pair per worker thread, all reading one source snapshot.
+
+    The coordinator connection exports its snapshot and every worker imports it, so
+    tables copied on different connections are still consistent with each other, the
+    same way pg_dump -j works.
+    """
+
+    def __init__(self, source_config, destination_config, snapshot):
+        self.source_config = source_config
+        self.destination_config = destination_config
+        self.snapshot = snapshot
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+        self.cancelled = False
+
+    def get(self):
+        """Return this thread's (source, destination) pair, inside the shared snapshot."""
+        if self.cancelled:
+            raise RuntimeError("the transfer was cancelled after another table failed")
+        if not hasattr(self._local, "pair"):
+            source_connection = psycopg2.connect(**self.source_config)
+            source_connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            destination_connection = psycopg2.connect(**self.destination_config)
+            self._local.pair = (source_connection, destination_connection)
+            with self._lock:
+                self._all.append(self._local.pair)
+        source_connection, destination_connection = self._local.pair
+        # ^ A retry rolls the source back, so the snapshot is imported again at every new transaction
+        if source_connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE:
+            with source_connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", (self.snapshot,))
+        return source_connection, destination_connection
+
+    def cancel(self):
+        """Abort the statements running on every worker; safe to call from any thread."""
+        self.cancelled = True
+        with self._lock:
+            pairs = list(self._all)
+        for pair in pairs:
+            for connection in pair:
+                if not connection.closed:
+                    connection.cancel()
+
+    def close(self):
+        for source_connection, destination_connection in self._all:
+            source_connection.close()
+            destination_connection.close()
+
+
+def export_snapshot(connection):
+    """Start a read-only snapshot on connection and return its id for other sessions to import."""
+    connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_export_snapshot()")
+        return cursor.fetchone()[0]
+
+
+def set_table_filter(include=(), exclude=()):
+    TABLE_FILTER.update(include=list(include), exclude=list(exclude))
+
+
+def _matches(patterns, schema, table):
+    return any(
+        fnmatch.fnmatchcase(f"{schema}.{table}" if "." in pattern else table, pattern)
+        for pattern in patterns
+    )
+
+
+def table_selected(schema, table):
+    """True when the table passes the include and exclude patterns of TABLE_FILTER."""
+    if TABLE_FILTER["include"] and not _matches(TABLE_FILTER["include"], schema, table):
+        return False
+    return not _matches(TABLE_FILTER["exclude"], schema, table)
+
+
+def table_filter_options():
+    """pg_dump -t/-T options for TABLE_FILTER; pg_dump patterns use the same * and ? wildcards."""
+    options = []
+    for pattern in TABLE_FILTER["include"]:
+        options += ["-t", pattern]
+    for pattern in TABLE_FILTER["exclude"]:
+        options += ["-T", pattern]
+    return options
+
+
+def list_tables(connection):
+    """Return (schema, table) pairs for every user table in the database that TABLE_FILTER selects."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT n.nspname, c.relname
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind = 'r'
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+              AND n.nspname NOT LIKE 'pg_toast%%'
+            ORDER BY n.nspname, c.relname
+            """
+        )
+        return [table for table in cursor.fetchall() if table_selected(*table)]
+
+
+def copy_table(
+    source_connection, destination_connection, schema, table, source_query=None, source_table=None
+):
+    """Stream one table from source to destination with binary COPY; returns (rows, bytes).
+
+    source_query optionally replaces the whole table with a SELECT producing its columns,
+    and source_table names the table they come from when the target is a staging table.
+    Without a source_query, the table's pushdown settings pick the columns and rows.
+    With row streaming turned on (streaming.set_batch_rows), or transforms configured for
+    the table, the rows go through Python in bounded batches instead.
+    """
+    if source_query is None and pushdown.is_pushed_down(schema, table):
+        source_query = pushdown.select(schema, table)
+    transform = transforms.row_transform(schema, source_table or table)
+    if streaming.SETTINGS["batch_rows"] or transform is not None:
+        return streaming.stream_table(
+            source_connection,
+            destination_connection,
+            schema,
+            table,
+            source_query,
+            transform,
+            streaming.SETTINGS["batch_rows"] or streaming.DEFAULT_BATCH_ROWS,
+        )
+    table_name = sql.Identifier(schema, table)
+    if source_query is None:
+        copy_out = sql.SQL("COPY {} TO STDOUT (FORMAT binary)").format(table_name)
+    else:
+        copy_out = sql.SQL("COPY ({}) TO STDOUT (FORMAT binary)").format(source_query)
+    columns = pushdown.columns_for(schema, source_table or table)
+    if columns is None:
+        copy_in = sql.SQL("COPY {} FROM STDIN (FORMAT binary)").format(table_name)
+    else:
+        # ^ Columns left out of the extract keep their default (NULL) on the destination
+        copy_in = sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary)").format(
+            table_name, sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+        )
+    pipe = BoundedPipe()
+
+    # * The source COPY runs on its own thread and blocks whenever the pipe is full
+    def extract():
+        error = None
+        try:
+            with source_connection.cursor() as cursor:
+                cursor.copy_expert(copy_out, pipe, size=pipe.chunk_bytes)
+        except Exception as e:
+            error = e
+        try:
+            pipe.close(error)
+        except RuntimeError:
+            pass  # ^ the reader already failed and reported its own error
+
+    extractor = threading.Thread(target=extract, name=f"copy-{schema}.{table}")
+    extractor.start()
+    try:
+        with destination_connection.cursor() as cursor:
+            cursor.copy_expert(copy_in, pipe, size=pipe.chunk_bytes)
+            rows = cursor.rowcount
+    except BaseException:
+        pipe.abort()
+        raise
+    finally:
+        extractor.join()
+    return rows, pipe.bytes
+
+
+def run_with_retries(source_connection, destination_connection, label, step):
+    """Run step() for one table (or chunk) and commit the destination, retrying on database errors.
+
+    step returns (rows, bytes); each attempt is a fresh destination transaction.
+    """
+    for attempt in range(1, TABLE_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            rows, size = step()
+            destination_connection.commit()
+            break
+        except psycopg2.Error as e:
+            # ! Each table loads in its own transaction, so a rollback discards only this table
+            destination_connection.rollback()
+            source_connection.rollback()
+            print(f"Copy of {label} failed (attempt {attempt}/{TABLE_RETRIES}): {e}")
+            # ^ A cancelled query means another table failed and the whole run is stopping
+            if attempt == TABLE_RETRIES or isinstance(e, errors.QueryCanceled):
+                raise
+            time.sleep(RETRY_DELAY_SECONDS * attempt)
+    elapsed = time.monotonic() - started
+    print(
+        f"Copied {label}: {rows} rows, {size} bytes in {elapsed:.2f}s"
+        f" (attempt {attempt})"
+    )
+    metrics.record_table(label, rows, size, elapsed, attempt - 1)
+    return rows, size
+
+
+def foreign_key_parents(connection):
+    """Map each (schema, table) to the set of tables its foreign keys reference."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT cn.nspname, c.relname, pn.nspname, p.relname
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace cn ON cn.oid = c.relnamespace
+            JOIN pg_class p ON p.oid = con.confrelid
+            JOIN pg_namespace pn ON pn.oid = p.relnamespace
+            WHERE con.contype = 'f'
+            """
+        )
+        parents = {}
+        for child_schema, child, parent_schema, parent in cursor.fetchall():
+            if (child_schema, child) != (parent_schema, parent):
+                parents.setdefault((child_schema, child), set()).add((parent_schema, parent))
+        return parents
+
+
+def sync_sequences(source_connection, destination_connection):
+    """Move every sequence on the destination to the value it has on the source."""
+    with source_connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT schemaname, sequencename, last_value FROM pg_sequences"
+            " WHERE last_value IS NOT NULL"
+        )
+        sequences = cursor.fetchall()
+    with destination_connection.cursor() as cursor:
+        for schema, name, last_value in sequences:
+            # ^ Sequences of tables left out by TABLE_FILTER do not exist on the destination
+            cursor.execute(
+                "SELECT setval(s.oid, %s, true) FROM (SELECT to_regclass(%s) AS oid) s"
+                " WHERE s.oid IS NOT NULL",
+                (last_value, sql.Identifier(schema, name).as_string(cursor)),
+            )
+    destination_connection.commit()
+
+
+def transfer_tables(source_config, destination_config, jobs=1, chunk_rows=None, run_id=None):
+    """Copy every source table into the (already created) destination tables on `jobs` threads.
+
+    Tables estimated above chunk_rows rows are split into primary key ranges that are
+    copied on their own pool of `jobs` threads; the others go through the local table
+    cache when one is configured (see table_cache). With a run_id (from checkpoints.start_run)
+    each table and chunk is checkpointed in the transaction that loads it, and whatever
+    that run already committed is skipped.
+    """
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    fingerprints = {}
+    if table_cache.enabled():
+        # ^ Taken before the snapshot, so a fingerprint is never newer than the rows it labels
+        fingerprints = table_cache.fingerprints(source_connection, list_tables(source_connection))
+    # * One exported snapshot keeps all tables consistent with each other, like pg_dump does
+    workers = WorkerConnections(
+        source_config, destination_config, export_snapshot(source_connection)
+    )
+    # ^ Chunks get a pool separate from the table pool so a table waiting on its chunks
+    # ^ can never hold the only threads those chunks could run on
+    chunk_pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        tables = list_tables(source_connection)
+        done = {}
+        if run_id is not None:
+            done = checkpoints.completed(destination_connection, run_id)
+
+        def load(table):
+            schema, name = table
+            if (schema, name, checkpoints.TABLE_DONE) in done:
+                print(f"Skipping {schema}.{name}: already copied by this run")
+                return
+            if chunk_rows:
+                worker_source, worker_destination = workers.get()
+                # ^ A resumed table must be cut at the same points as before, whatever the stats say now
+                plan = None
+                if run_id is not None:
+                    plan = checkpoints.chunk_plan(worker_destination, run_id, schema, name)
+                if plan is None:
+                    plan = chunking.plan_chunks(worker_source, schema, name, chunk_rows)
+                    if run_id is not None and plan[1]:
+                        checkpoints.save_chunk_plan(worker_destination, run_id, schema, name, *plan)
+                column, points = plan
+                if points:
+                    chunking.copy_table_in_chunks(
+                        workers, chunk_pool, schema, name, column, points, run_id, done
+                    )
+                    return
+
+            def step():
+                worker_source, worker_destination = workers.get()
+                if table_cache.enabled():
+                    rows, size = table_cache.copy_table(
+                        worker_source, worker_destination, schema, name, fingerprints.get(table)
+                    )
+                else:
+                    rows, size = copy_table(worker_source, worker_destination, schema, name)
+                if run_id is not None:
+                    checkpoints.record(
+                        worker_destination, run_id, schema, name, checkpoints.TABLE_DONE, rows, size
+                    )
+                return rows, size
+
+            run_with_retries(*workers.get(), f"{schema}.{name}", step)
+
+        scheduler.run_in_dependency_order(
+            tables, foreign_key_parents(source_connection), jobs, load, on_failure=workers.cancel
+        )
+
+        sync_sequences(source_connection, destination_connection)
+        source_connection.commit()
+    finally:
+        chunk_pool.shutdown()
+        workers.close()
+        source_connection.close()
+        destination_connection.close()
@@ -1,35 +1,59 @@
+import argparse
+import asyncio
+import os
+import shutil
 import subprocess  # to control inputs and outputs
-import time
+
+import aio
+import cdc
+import checkpoints
+import compression
+import copy_engine
+import fast_load
+import incremental
+import landing
+import merge
+import metrics
+import pushdown
+import schema_sync
+import streaming
+import swap
+import table_cache
+import transforms
+import verify
+
+# * Size of each read from pg_dump while streaming; at most one chunk sits in memory at a time
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+# * Directory-format dumps are written here (one file per table) so several workers can share them
+DUMP_DIRECTORY = "data_dump"
+
+# * Fast-load mode keeps the small post-data archive and its filtered restore list here
+POST_DATA_ARCHIVE = "post_data.dump"
+POST_DATA_LIST = "post_data.list"
 
 
 # run a fallback (double check that elt script will not run unless source and destination databases and working)
-def wait_for_postgres(host, max_retries=5, delay_seconds=5):
-    """Wait for PostgreSQL to become available."""
-    retries = 0
-    while retries < max_retries:
-        try:
-            result = subprocess.run(
-                ["pg_isready", "-h", host], check=True, capture_output=True, text=True
-            )
-            if "accepting connections" in result.stdout:
-                print("Successfully connected to PostgreSQL!")
-                return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error connecting to PostgreSQL: {e}")
-            retries += 1
-            print(
-                f"Retrying in {delay_seconds} seconds... (Attempt {retries}/{max_retries})"
-            )
-            time.sleep(delay_seconds)
-    print("Max retries reached. Exiting.")
-    return False
+def wait_for_postgres(configs, timeout_seconds=60, first_delay_seconds=0.1, max_delay_seconds=5):
+    """Wait until every database accepts a login and answers SELECT 1, probing them concurrently.
+
+    Each database is retried with exponential backoff and full jitter, so a database
+    that comes up quickly is noticed within a fraction of a second while a slow one is
+    not hammered. The probes are non-blocking connections on one event loop.
+    """
 
+    async def probe_all():
+        deadline = asyncio.get_running_loop().time() + timeout_seconds
+        results = await aio.gather_or_cancel(
+            [
+                aio.wait_until_ready(config, deadline, first_delay_seconds, max_delay_seconds)
+                for config in configs
+            ]
+        )
+        return all(results)
 
-# * Use the function before running the ELT process
-if not wait_for_postgres(host="source_postgres"):
-    exit(1)
+    return asyncio.run(probe_all())
 
-print("Starting ELT script...")
 
 # * Configuration for the source PostgreSQL database
 source_config = {
@@ -49,44 +73,654 @@ destination_config = {
     "host": "destination_postgres",
 }
 
-# * Use pg_dump to dump the source database to a SQL file
-dump_command = [
-    "pg_dump",
-    "-h",
-    source_config["host"],
-    "-U",
-    source_config["user"],
-    "-d",
-    source_config["dbname"],
-    "-f",
-    "data_dump.sql",
-    "-w",  # Do not prompt for password
-]
-
-# * Set the PGPASSWORD environment variable to avoid password prompt
-subprocess_env = dict(PGPASSWORD=source_config["password"])
-
-# * Execute the dump command
-subprocess.run(dump_command, env=subprocess_env, check=True)
-
-# * Use psql to load the dumped SQL file into the destination database
-load_command = [
-    "psql",
-    "-h",
-    destination_config["host"],
-    "-U",
-    destination_config["user"],
-    "-d",
-    destination_config["dbname"],
-    "-a",
-    "-f",
-    "data_dump.sql",
-]
-
-# * Set the PGPASSWORD environment variable for the destination database
-subprocess_env = dict(PGPASSWORD=destination_config["password"])
-
-# * Execute the load command
-subprocess.run(load_command, env=subprocess_env, check=True)
-
-print("Ending ELT script...")
+
+def client_env(config):
+    """Environment for pg_dump/psql/pg_restore: the password, plus the port when one is configured."""
+    env = dict(PGPASSWORD=config["password"])
+    if "port" in config:
+        env["PGPORT"] = str(config["port"])
+    return env
+
+
+def dump_and_load(codec=None, level=None, threads=0):
+    """Dump the source to data_dump.sql (compressed with codec, if any), then replay it into the destination."""
+    compressed = codec not in (None, "none")
+    dump_file = "data_dump.sql" + compression.extension(codec)
+
+    # * Use pg_dump to dump the source database to a SQL file
+    dump_command = [
+        "pg_dump",
+        "-h",
+        source_config["host"],
+        "-U",
+        source_config["user"],
+        "-d",
+        source_config["dbname"],
+        "-w",  # Do not prompt for password
+        *copy_engine.table_filter_options(),
+    ]
+    if not compressed:
+        dump_command += ["-f", dump_file]
+
+    # * Set the PGPASSWORD environment variable to avoid password prompt
+    subprocess_env = client_env(source_config)
+
+    # * Execute the dump command
+    with metrics.stage("dump"):
+        if compressed:
+            # ^ pg_dump writes to a pipe and the text is compressed on its way to disk
+            dump_process = subprocess.Popen(dump_command, env=subprocess_env, stdout=subprocess.PIPE)
+            try:
+                with compression.open_writer(dump_file, codec, level, threads) as spool:
+                    shutil.copyfileobj(dump_process.stdout, spool, STREAM_CHUNK_BYTES)
+            except BaseException:
+                # ! Writing the spool failed; stop pg_dump rather than leave it blocked on the pipe
+                dump_process.kill()
+                dump_process.wait()
+                raise
+            dump_process.stdout.close()
+            if dump_process.wait() != 0:
+                raise subprocess.CalledProcessError(dump_process.returncode, dump_command)
+        else:
+            subprocess.run(dump_command, env=subprocess_env, check=True)
+
+    # * Use psql to load the dumped SQL file into the destination database
+    load_command = [
+        "psql",
+        "-h",
+        destination_config["host"],
+        "-U",
+        destination_config["user"],
+        "-d",
+        destination_config["dbname"],
+        "-a",
+    ]
+    if compressed:
+        # ^ psql reads the spool from a pipe here, so only ON_ERROR_STOP tells a failed load
+        load_command += ["-v", "ON_ERROR_STOP=1"]
+    else:
+        load_command += ["-f", dump_file]
+
+    # * Set the PGPASSWORD environment variable for the destination database
+    subprocess_env = client_env(destination_config)
+
+    # * Execute the load command
+    with metrics.stage("load"):
+        if compressed:
+            load_process = subprocess.Popen(load_command, env=subprocess_env, stdin=subprocess.PIPE)
+            try:
+                with compression.open_reader(dump_file, codec) as spool:
+                    shutil.copyfileobj(spool, load_process.stdin, STREAM_CHUNK_BYTES)
+                load_process.stdin.close()
+            except BrokenPipeError:
+                # ! psql went away mid-load; report psql's failure
+                raise subprocess.CalledProcessError(load_process.wait(), load_command) from None
+            except BaseException:
+                # ! Reading the spool failed; stop psql before it sees end-of-input
+                load_process.kill()
+                load_process.wait()
+                raise
+            if load_process.wait() != 0:
+                raise subprocess.CalledProcessError(load_process.returncode, load_command)
+        else:
+            subprocess.run(load_command, env=subprocess_env, check=True)
+
+
+def stream_dump_to_destination(dump_options=()):
+    """Pipe pg_dump output straight into psql without staging a file on disk."""
+    if "-t" not in dump_options:
+        # ^ Options that already name their tables are not widened to the whole table filter
+        dump_options = [*copy_engine.table_filter_options(), *dump_options]
+    dump_command = [
+        "pg_dump",
+        "-h",
+        source_config["host"],
+        "-U",
+        source_config["user"],
+        "-d",
+        source_config["dbname"],
+        "-w",  # Do not prompt for password
+        *dump_options,
+    ]
+
+    # ^ ON_ERROR_STOP makes psql exit non-zero on the first failed statement, and
+    # ^ --single-transaction means a failure on either side leaves the destination untouched
+    load_command = [
+        "psql",
+        "-h",
+        destination_config["host"],
+        "-U",
+        destination_config["user"],
+        "-d",
+        destination_config["dbname"],
+        "-v",
+        "ON_ERROR_STOP=1",
+        "--single-transaction",
+        "-w",
+    ]
+
+    dump_process = subprocess.Popen(
+        dump_command,
+        env=client_env(source_config),
+        stdout=subprocess.PIPE,
+    )
+    load_process = subprocess.Popen(
+        load_command,
+        env=client_env(destination_config),
+        stdin=subprocess.PIPE,
+    )
+
+    # * Relay the dump chunk by chunk; a blocked write on a slow psql stalls pg_dump too,
+    # * so memory stays bounded by the pipe buffers plus one chunk
+    try:
+        for chunk in iter(lambda: dump_process.stdout.read(STREAM_CHUNK_BYTES), b""):
+            load_process.stdin.write(chunk)
+    except BrokenPipeError:
+        # ! psql went away mid-stream; stop pg_dump and report psql's failure
+        dump_process.kill()
+        dump_process.wait()
+        raise subprocess.CalledProcessError(load_process.wait(), load_command)
+    dump_process.stdout.close()
+    dump_returncode = dump_process.wait()
+
+    if dump_returncode != 0:
+        # ! Kill psql before it sees end-of-input so the open transaction is rolled back
+        # ! instead of committing a partial dump
+        load_process.kill()
+        load_process.wait()
+        raise subprocess.CalledProcessError(dump_returncode, dump_command)
+
+    try:
+        load_process.stdin.close()
+    except BrokenPipeError:
+        pass
+    load_returncode = load_process.wait()
+    if load_returncode != 0:
+        raise subprocess.CalledProcessError(load_returncode, load_command)
+
+
+def parallel_dump_and_restore(jobs, codec=None, level=None):
+    """Dump with per-table workers into a directory, then restore it with per-table workers."""
+    # ^ pg_dump refuses to write into an existing directory, so clear any previous run
+    shutil.rmtree(DUMP_DIRECTORY, ignore_errors=True)
+
+    # * -Fd is the only format pg_dump can write in parallel; -j sets the number of worker connections
+    dump_command = [
+        "pg_dump",
+        "-h",
+        source_config["host"],
+        "-U",
+        source_config["user"],
+        "-d",
+        source_config["dbname"],
+        "-Fd",
+        "-j",
+        str(jobs),
+        "-f",
+        DUMP_DIRECTORY,
+        "-w",  # Do not prompt for password
+        # ^ pg_dump compresses each table file itself, on its own worker processes
+        *compression.pg_dump_options(codec, level),
+        *copy_engine.table_filter_options(),
+    ]
+    with metrics.stage("dump"):
+        subprocess.run(dump_command, env=client_env(source_config), check=True)
+
+    # * pg_restore loads independent tables concurrently and builds indexes and constraints afterwards
+    restore_command = [
+        "pg_restore",
+        "-h",
+        destination_config["host"],
+        "-U",
+        destination_config["user"],
+        "-d",
+        destination_config["dbname"],
+        "-j",
+        str(jobs),
+        "--exit-on-error",
+        "-w",
+        DUMP_DIRECTORY,
+    ]
+    with metrics.stage("restore"):
+        subprocess.run(restore_command, env=client_env(destination_config), check=True)
+
+
+def restore_remaining_post_data(dump_options=()):
+    """Restore the post-data objects (triggers, rules, ...) that fast_load does not build itself."""
+    if "-t" not in dump_options:
+        dump_options = [*copy_engine.table_filter_options(), *dump_options]
+    dump_command = [
+        "pg_dump",
+        "-h",
+        source_config["host"],
+        "-U",
+        source_config["user"],
+        "-d",
+        source_config["dbname"],
+        "-Fc",
+        "--section=post-data",
+        *dump_options,
+        "-f",
+        POST_DATA_ARCHIVE,
+        "-w",  # Do not prompt for password
+    ]
+    subprocess.run(dump_command, env=client_env(source_config), check=True)
+
+    toc = subprocess.run(
+        ["pg_restore", "-l", POST_DATA_ARCHIVE], check=True, capture_output=True, text=True
+    )
+    entries = fast_load.remaining_post_data(toc.stdout.splitlines())
+    if not any(not line.startswith(";") for line in entries):
+        return
+    with open(POST_DATA_LIST, "w") as restore_list:
+        restore_list.write("\n".join(entries) + "\n")
+
+    restore_command = [
+        "pg_restore",
+        "-h",
+        destination_config["host"],
+        "-U",
+        destination_config["user"],
+        "-d",
+        destination_config["dbname"],
+        "-L",
+        POST_DATA_LIST,
+        "--exit-on-error",
+        "--single-transaction",
+        "-w",
+        POST_DATA_ARCHIVE,
+    ]
+    subprocess.run(restore_command, env=client_env(destination_config), check=True)
+
+
+def create_changed_tables(empty_unchanged, fast=False):
+    """Replay pre-data DDL only for tables whose schema fingerprint changed.
+
+    Changed tables are dropped and recreated; with empty_unchanged the unchanged ones are
+    truncated for a full reload, and with fast as well they lose their keys, indexes and
+    foreign keys until finish_changed_tables. Returns (source fingerprints, changed tables).
+    """
+    fingerprints, changed, present = schema_sync.plan(source_config, destination_config)
+    print(f"Schema: {len(changed)} of {len(fingerprints)} tables need DDL")
+    schema_sync.drop_tables(destination_config, changed & present)
+    if empty_unchanged:
+        if fast:
+            fast_load.drop_indexes_and_constraints(destination_config, present - changed)
+        schema_sync.truncate_tables(destination_config, present - changed)
+    if not present:
+        # * Nothing there yet: replay all of it, including schemas, types and functions
+        stream_dump_to_destination(["--section=pre-data"])
+    elif changed:
+        stream_dump_to_destination(["--section=pre-data", *schema_sync.dump_options(changed)])
+    # ^ Tables with in-flight transforms get their extra or text columns, changed or not
+    transforms.apply_schema(destination_config, list(fingerprints))
+    return fingerprints, changed
+
+
+def finish_changed_tables(fingerprints, changed, jobs, fast=False):
+    """Add the post-data objects of the recreated tables, then record the new fingerprints.
+
+    With fast, the keys and indexes of truncated tables are rebuilt as well; their
+    triggers and other post-data objects were never dropped.
+    """
+    if fast:
+        # ^ Keys and indexes built in parallel, foreign keys added NOT VALID and validated after
+        fast_load.build_indexes_and_constraints(source_config, destination_config, jobs)
+        if changed:
+            with metrics.stage("post_data"):
+                restore_remaining_post_data(schema_sync.dump_options(changed))
+    elif changed:
+        with metrics.stage("post_data"):
+            stream_dump_to_destination(["--section=post-data", *schema_sync.dump_options(changed)])
+    schema_sync.store_fingerprints(destination_config, fingerprints)
+
+
+def copy_transfer(jobs, chunk_rows=None, fast=False, resume=True):
+    """Create the schema with pg_dump, then move the rows with the in-process binary COPY engine.
+
+    Progress is checkpointed on the destination; with resume, a run after a failed one
+    picks up from the last committed table or chunk instead of starting over.
+    """
+    unfinished = checkpoints.unfinished_run(destination_config) if resume else None
+    if unfinished is None:
+        # * Tables and sequences first, data next, then indexes and constraints once the rows are in
+        with metrics.stage("pre_data"):
+            fingerprints, changed = create_changed_tables(empty_unchanged=True, fast=fast)
+        run_id, data_loaded = checkpoints.start_run(destination_config), False
+    else:
+        run_id, data_loaded = unfinished
+        print(f"Resuming copy run {run_id}")
+        # ^ Fingerprints are stored only at the end, so this finds the same changed tables
+        fingerprints, changed, _ = schema_sync.plan(source_config, destination_config)
+    if not data_loaded:
+        # ! A resumed run reads a newer snapshot than the tables it already copied
+        with metrics.stage("copy"):
+            copy_engine.transfer_tables(
+                source_config, destination_config, jobs, chunk_rows, run_id
+            )
+        checkpoints.mark_data_loaded(destination_config, run_id)
+    finish_changed_tables(fingerprints, changed, jobs, fast)
+    checkpoints.finish_run(destination_config, run_id)
+
+
+def incremental_transfer(watermark_columns, jobs):
+    """Copy only rows past each table's stored high-watermark, recreating tables whose schema changed."""
+    with metrics.stage("pre_data"):
+        fingerprints, changed = create_changed_tables(empty_unchanged=False)
+    with metrics.stage("copy"):
+        incremental.transfer_increments(
+            source_config, destination_config, watermark_columns, jobs
+        )
+    finish_changed_tables(fingerprints, changed, jobs)
+
+
+def merge_transfer(jobs, chunk_rows=None):
+    """Upsert every table on its primary key, so only rows that changed are rewritten."""
+    with metrics.stage("pre_data"):
+        fingerprints, changed = create_changed_tables(empty_unchanged=False)
+    merge.merge_tables(source_config, destination_config, jobs, chunk_rows)
+    finish_changed_tables(fingerprints, changed, jobs)
+
+
+def swap_transfer(jobs, chunk_rows=None):
+    """Reload every table into a staging copy while readers keep the old one, then swap them in."""
+    with metrics.stage("pre_data"):
+        fingerprints, changed = create_changed_tables(empty_unchanged=False)
+    # ^ Recreated tables are still empty, so they get their keys now and the swap copies them
+    finish_changed_tables(fingerprints, changed, jobs)
+    swap.reload_and_swap(source_config, destination_config, jobs, chunk_rows)
+
+
+def change_data_capture(batch_size, poll_seconds, jobs):
+    """Replicate source changes through a logical replication slot, seeding the destination first."""
+    cdc.ensure_slot(source_config)
+    # ^ The slot is created before the initial copy, so nothing committed in between is lost;
+    # ^ changes the copy already contains are replayed as idempotent upserts
+    # ! A seed that failed or was interrupted is resumed, even though its slot already exists
+    if checkpoints.unfinished_run(destination_config) is not None or not (
+        incremental.destination_has_schema(source_config, destination_config)
+    ):
+        copy_transfer(jobs, fast=True)
+    with metrics.stage("cdc"):
+        cdc.stream_changes(source_config, destination_config, batch_size, poll_seconds)
+
+
+def landing_transfer(directory, jobs, codec, partition_columns):
+    """Write the source tables to the Parquet landing zone, next to whatever the mode loaded."""
+    with metrics.stage("landing"):
+        landing.land_tables(source_config, directory, jobs, codec, partition_columns)
+
+
+def verify_destination(jobs, chunk_rows):
+    """Fail the run if any table or key range differs between source and destination."""
+    with metrics.stage("verify"):
+        mismatches = verify.verify_tables(source_config, destination_config, jobs, chunk_rows)
+    if mismatches:
+        raise RuntimeError(f"{len(mismatches)} table chunks differ between source and destination")
+
+
+def parse_table_column(value):
+    """Parse a TABLE=COLUMN command-line setting."""
+    table, separator, column = value.partition("=")
+    if not separator or not table or not column:
+        raise argparse.ArgumentTypeError(f"expected TABLE=COLUMN, got {value!r}")
+    return table, column
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Copy source_db into destination_db.")
+    parser.add_argument(
+        "--mode",
+        choices=[
+            "dump",
+            "stream",
+            "parallel",
+            "copy",
+            "swap",
+            "merge",
+            "incremental",
+            "cdc",
+            "verify",
+            "landing",
+        ],
+        default="dump",
+        help="dump: stage data_dump.sql on disk then load it; "
+        "stream: pipe pg_dump straight into psql, replacing the tables it dumps; "
+        "parallel: directory-format dump and restore with --jobs workers; "
+        "copy: per-table binary COPY streamed in-process; "
+        "swap: binary COPY into staging copies that replace the live tables at once; "
+        "merge: binary COPY into staging tables, upserted on each primary key; "
+        "incremental: binary COPY of only the rows added since the last run (the "
+        "watermark waits for transactions still open, so rows they commit late are not "
+        "skipped); "
+        "cdc: apply inserts, updates and deletes from a logical replication slot; "
+        "verify: only compare the destination with the source; "
+        "landing: only write the Parquet landing zone",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker connections used on each side in parallel, copy, "
+        "incremental and cdc modes",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=10_000_000,
+        help="in copy, swap and merge modes, split tables estimated above this many rows "
+        "into primary key ranges copied in parallel; 0 disables chunking",
+    )
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=0,
+        help="in copy, swap, merge and incremental modes, pull rows through a server-side "
+        "cursor in batches of this many rows, holding a fixed number of batches in memory, "
+        "instead of passing the COPY data through untouched; 0 disables it",
+    )
+    parser.add_argument(
+        "--transforms",
+        help="YAML file of per-table transforms (lower, hash, age_bucket, map, drop) applied "
+        "to Arrow batches between extract and load in copy, swap, merge, incremental and "
+        "landing modes",
+    )
+    parser.add_argument(
+        "--pushdown",
+        help="YAML file of per-table columns and where settings pushed into the source "
+        "queries; columns left out stay NULL on the destination",
+    )
+    parser.add_argument(
+        "--dbt-manifest",
+        help="derive each table's columns from the models in this compiled dbt manifest "
+        "(e.g. ../custom_postgres/target/manifest.json); --pushdown entries win",
+    )
+    parser.add_argument(
+        "--fast-load",
+        action="store_true",
+        help="in copy mode, build keys and indexes in parallel after the load and add "
+        "foreign keys as NOT VALID before validating them",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="in copy mode, keep unchunked tables in memory-mappable Arrow files here and "
+        "load tables whose change fingerprint is unchanged from them, without reading the source",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=1024 ** 3,
+        help="disk the table cache may use before least recently used tables are evicted",
+    )
+    parser.add_argument(
+        "--cache-fingerprint",
+        choices=["xmin", "stats"],
+        default="xmin",
+        help="xmin: row count and newest xmin of each table (exact, but scans it); "
+        "stats: pg_stat_user_tables counters (free, but they lag commits by up to a minute, "
+        "so a table changed in that window is loaded stale from the cache)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="in copy mode, start a new run instead of resuming an unfinished one from "
+        "its checkpoints",
+    )
+    parser.add_argument(
+        "--watermark-column",
+        type=parse_table_column,
+        action="append",
+        default=[],
+        metavar="TABLE=COLUMN",
+        help="column tracked for a table in incremental mode (default: its serial primary key)",
+    )
+    parser.add_argument(
+        "--cdc-batch-size",
+        type=int,
+        default=10000,
+        help="approximate number of row changes applied per destination transaction in cdc mode",
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=5,
+        help="pause between polls of the replication slot in cdc mode; 0 drains once and exits",
+    )
+    parser.add_argument(
+        "--wait-seconds",
+        type=float,
+        default=60,
+        help="how long to wait for both databases to accept connections before giving up",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(compression.EXTENSIONS),
+        help="codec for the dump spool in dump mode and for the archive in parallel mode "
+        "(lz4/zstd there need pg_dump 16+); default: uncompressed dump, pg_dump's gzip archive",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="codec level (default: a fast level for each codec)",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        type=int,
+        default=0,
+        help="extra zstd compression threads in dump mode; -1 uses one per CPU",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="after the transfer, compare per-chunk row counts and row hashes on both sides",
+    )
+    parser.add_argument(
+        "--verify-chunk-rows",
+        type=int,
+        default=1_000_000,
+        help="approximate rows per primary key range compared during verification",
+    )
+    parser.add_argument(
+        "--landing-dir",
+        help="also write every source table as compressed Parquet under this directory, "
+        "one run=<UTC timestamp> partition per run (default in landing mode: landing)",
+    )
+    parser.add_argument(
+        "--landing-compression",
+        choices=landing.CODECS,
+        default="zstd",
+        help="Parquet codec for the landing zone",
+    )
+    parser.add_argument(
+        "--landing-partition",
+        type=parse_table_column,
+        action="append",
+        default=[],
+        metavar="TABLE=COLUMN",
+        help="split a table's landing files into one directory per value of COLUMN "
+        "(pick a low-cardinality column such as films=rating)",
+    )
+    parser.add_argument(
+        "--report-json",
+        default="elt_run_report.json",
+        help="where to write the JSON run report with per-stage and per-table timings",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        default="elt_run.prom",
+        help="where to write the run metrics for the node_exporter textfile collector",
+    )
+    return parser.parse_args(argv)
+
+
+def run(args):
+    if args.transforms:
+        transforms.set_transforms(transforms.load_file(args.transforms))
+    if args.pushdown:
+        pushdown.set_pushdown(pushdown.load_file(args.pushdown))
+    if args.dbt_manifest:
+        pushdown.set_derived(pushdown.from_dbt_manifest(args.dbt_manifest, source_config))
+    configured = transforms.TRANSFORMS or pushdown.PUSHDOWN or pushdown.DERIVED
+    if configured and args.mode in ("dump", "stream", "parallel", "cdc"):
+        raise ValueError(
+            f"{args.mode} mode moves data without the COPY engine, so it cannot apply "
+            "transforms or pushdown settings"
+        )
+    if args.mode == "parallel":
+        compression.check_pg_dump(args.compression)
+    pushdown.resolve(source_config)
+    streaming.set_batch_rows(args.batch_rows)
+    table_cache.configure(args.cache_dir, args.cache_max_bytes, args.cache_fingerprint)
+    if args.mode == "stream":
+        with metrics.stage("stream"):
+            # ^ Drop what a previous run loaded, inside the same transaction, so reruns work
+            stream_dump_to_destination(["--clean", "--if-exists"])
+    elif args.mode == "parallel":
+        parallel_dump_and_restore(args.jobs, args.compression, args.compression_level)
+    elif args.mode == "copy":
+        copy_transfer(args.jobs, args.chunk_rows, args.fast_load, not args.restart)
+    elif args.mode == "merge":
+        merge_transfer(args.jobs, args.chunk_rows)
+    elif args.mode == "swap":
+        swap_transfer(args.jobs, args.chunk_rows)
+    elif args.mode == "incremental":
+        incremental_transfer(dict(args.watermark_column), args.jobs)
+    elif args.mode == "cdc":
+        change_data_capture(args.cdc_batch_size, args.poll_seconds, args.jobs)
+    elif args.mode in ("verify", "landing"):
+        pass  # ^ verification or the landing zone below is the whole run
+    else:
+        dump_and_load(args.compression, args.compression_level, args.compression_threads)
+
+    landing_dir = args.landing_dir or ("landing" if args.mode == "landing" else None)
+    if landing_dir:
+        landing_transfer(
+            landing_dir, args.jobs, args.landing_compression, dict(args.landing_partition)
+        )
+    if args.verify or args.mode == "verify":
+        verify_destination(args.jobs, args.verify_chunk_rows)
+
+
+def main(argv=None, pipeline=None):
+    """Run one transfer; pipelines.py calls this once per configured pipeline."""
+    args = parse_args(argv)
+    metrics.start_run(args.mode, pipeline)
+    succeeded = False
+    try:
+        # * Use the function before running the ELT process
+        with metrics.stage("wait"):
+            ready = wait_for_postgres([source_config, destination_config], args.wait_seconds)
+        if not ready:
+            exit(1)
+
+        print("Starting ELT script...")
+        run(args)
+        succeeded = True
+        print("Ending ELT script...")
+    finally:
+        # ^ Written on failure too, so a failed run shows up as elt_run_success 0
+        metrics.write_reports(succeeded, args.report_json, args.prometheus_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+
+import copy_engine
+import metrics
+
+# * Memory each index build may use on the destination; bigger sorts finish in fewer passes
+MAINTENANCE_WORK_MEM = "512MB"
+
+# * pg_restore TOC entry types this module builds itself; everything else in post-data is
+# * left to pg_restore (triggers, rules, policies, ...)
+BUILT_HERE = re.compile(r"^\d+; \d+ \d+ (CONSTRAINT|FK CONSTRAINT|INDEX|INDEX ATTACH) ")
+
+# * Index definitions are rewritten to CREATE INDEX IF NOT EXISTS so a rerun skips built ones
+CREATE_INDEX = re.compile(r"^(CREATE (?:UNIQUE )?INDEX) ")
+
+
+def key_constraints(connection):
+    """Primary key, unique and exclusion constraints as (schema, table, name, definition)."""
+    return _constraints(connection, ("p", "u", "x"))
+
+
+def foreign_keys(connection):
+    """Foreign key constraints as (schema, table, name, definition)."""
+    return _constraints(connection, ("f",))
+
+
+def _constraints(connection, types):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT n.nspname, c.relname, con.conname, pg_get_constraintdef(con.oid)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE con.contype = ANY (%s)
+              AND con.conparentid = 0
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+            ORDER BY 1, 2, 3
+            """,
+            (list(types),),
+        )
+        return [row for row in cursor.fetchall() if copy_engine.table_selected(row[0], row[1])]
+
+
+def standalone_indexes(connection):
+    """CREATE INDEX statements for indexes that do not back a key constraint."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT n.nspname, c.relname, pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+              AND n.nspname NOT LIKE 'pg_toast%%'
+              AND NOT c.relispartition
+              AND NOT EXISTS (
+                  SELECT 1 FROM pg_constraint con
+                  WHERE con.conindid = i.indexrelid AND con.contype IN ('p', 'u', 'x')
+              )
+            ORDER BY 3
+            """
+        )
+        return [
+            definition
+            for schema, table, definition in cursor.fetchall()
+            if copy_engine.table_selected(schema, table)
+        ]
+
+
+def run_statements(destination_config, statements, jobs):
+    """Run independent DDL statements on up to `jobs` destination connections at once."""
+    def run(statement):
+        connection = psycopg2.connect(**destination_config)
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+                cursor.execute(statement)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        # ^ list() re-raises the first failed statement
+        list(pool.map(run, statements))
+
+
+def build_indexes_and_constraints(source_config, destination_config, jobs):
+    """Add keys, indexes and foreign keys to freshly bulk-loaded destination tables.
+
+    Keys and indexes are built concurrently. Foreign keys are added NOT VALID, which
+    takes a moment, and then validated on `jobs` connections. A validation takes SHARE
+    UPDATE EXCLUSIVE, which lets reads and writes carry on but conflicts with itself,
+    so validations of foreign keys on different tables overlap while those on the same
+    table wait for each other. Objects that already exist on the destination are left
+    alone, so a resumed run can call this again.
+    """
+    source_connection = psycopg2.connect(**source_config)
+    try:
+        # ^ An empty search_path makes pg_get_*def schema-qualify every name it prints
+        with source_connection.cursor() as cursor:
+            cursor.execute("SELECT pg_catalog.set_config('search_path', '', false)")
+        keys = key_constraints(source_connection)
+        indexes = standalone_indexes(source_connection)
+        references = foreign_keys(source_connection)
+    finally:
+        source_connection.close()
+
+    def add_constraint(schema, table, name, definition, suffix=""):
+        return sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}{}").format(
+            sql.Identifier(schema, table),
+            sql.Identifier(name),
+            sql.SQL(definition),
+            sql.SQL(suffix),
+        )
+
+    # * Keys first: a foreign key needs the referenced key to exist
+    destination_connection = psycopg2.connect(**destination_config)
+    try:
+        existing = {
+            (schema, table, name)
+            for schema, table, name, _ in _constraints(destination_connection, ("p", "u", "x", "f"))
+        }
+        destination_connection.commit()
+        statements = [
+            add_constraint(*key).as_string(destination_connection)
+            for key in keys
+            if key[:3] not in existing
+        ]
+        statements += [CREATE_INDEX.sub(r"\1 IF NOT EXISTS ", index) for index in indexes]
+        with metrics.stage("keys_and_indexes"):
+            run_statements(destination_config, statements, jobs)
+        print(f"Built {len(keys)} keys and {len(indexes)} indexes")
+
+        with metrics.stage("foreign_keys"), destination_connection.cursor() as cursor:
+            for reference in references:
+                if reference[:3] in existing:
+                    continue
+                cursor.execute(add_constraint(*reference, suffix=" NOT VALID"))
+        destination_connection.commit()
+
+        validations = [
+            sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}")
+            .format(sql.Identifier(schema, table), sql.Identifier(name))
+            .as_string(destination_connection)
+            for schema, table, name, _ in references
+        ]
+    finally:
+        destination_connection.close()
+    with metrics.stage("validate_foreign_keys"):
+        run_statements(destination_config, validations, jobs)
+    print(f"Validated {len(references)} foreign keys")
+
+
+def drop_indexes_and_constraints(destination_config, tables):
+    """Drop the keys, indexes and foreign keys of destination tables about to be reloaded.
+
+    build_indexes_and_constraints puts them back once the rows are in. A key that a
+    foreign key from a table outside `tables` depends on stays, and so does that
+    foreign key.
+    """
+    if not tables:
+        return
+    connection = psycopg2.connect(**destination_config)
+    try:
+        with connection.cursor() as cursor:
+            names = [sql.Identifier(*table).as_string(cursor) for table in sorted(tables)]
+            cursor.execute(
+                """
+                WITH reloaded AS (SELECT unnest(%s::text[])::regclass AS oid)
+                SELECT con.conrelid::regclass::text, quote_ident(con.conname)
+                FROM pg_constraint con
+                WHERE con.conparentid = 0
+                  AND con.conrelid IN (SELECT oid FROM reloaded)
+                  AND (
+                      con.contype = 'f'
+                      OR con.contype IN ('p', 'u', 'x') AND NOT EXISTS (
+                          SELECT 1 FROM pg_constraint outside
+                          WHERE outside.contype = 'f'
+                            AND outside.conindid = con.conindid
+                            AND outside.conrelid NOT IN (SELECT oid FROM reloaded)
+                      )
+                  )
+                -- ^ Foreign keys first: a key cannot go while one still references it
+                ORDER BY con.contype <> 'f'
+                """,
+                (names,),
+            )
+            constraints = cursor.fetchall()
+            cursor.execute(
+                """
+                SELECT i.indexrelid::regclass::text
+                FROM pg_index i
+                WHERE i.indrelid IN (SELECT unnest(%s::text[])::regclass)
+                  AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid)
+                  AND NOT EXISTS (SELECT 1 FROM pg_inherits h WHERE h.inhrelid = i.indexrelid)
+                """,
+                (names,),
+            )
+            indexes = [row[0] for row in cursor.fetchall()]
+            for table, name in constraints:
+                cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+            for index in indexes:
+                cursor.execute(f"DROP INDEX {index}")
+        connection.commit()
+    finally:
+        connection.close()
+    print(f"Dropped {len(constraints)} constraints and {len(indexes)} indexes before the reload")
+
+
+def remaining_post_data(toc_lines):
+    """Keep the pg_restore TOC entries that build_indexes_and_constraints does not create."""
+    return [line for line in toc_lines if line.strip() and not BUILT_HERE.match(line)]
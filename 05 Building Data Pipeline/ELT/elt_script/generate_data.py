@@ -0,0 +1,162 @@
+import argparse
+import random
+import time
+from datetime import date, timedelta
+
+import psycopg2
+
+from elt_script import source_config
+
+# * Rows are streamed to COPY in blocks of this many lines, so memory stays flat at any scale
+ROWS_PER_BLOCK = 10000
+COPY_READ_BYTES = 1024 * 1024
+
+FIRST_NAMES = ["John", "Jane", "Alice", "Bob", "Emily", "Michael", "Sarah", "David", "Sophia", "James"]
+LAST_NAMES = ["Doe", "Smith", "Johnson", "Williams", "Clark", "Robinson", "Lewis", "Walker", "Hall", "Allen"]
+RATINGS = ["G", "PG", "PG-13", "R", "NC-17"]
+CATEGORIES = [
+    "Action", "Adventure", "Animation", "Comedy", "Crime", "Drama",
+    "Family", "Music", "Romance", "Sci-Fi", "Thriller", "War",
+]
+
+# * Per film: how many categories and actors it gets
+CATEGORIES_PER_FILM = 2
+ACTORS_PER_FILM = 3
+
+
+class RowStream:
+    """File-like object that renders rows into COPY text format on demand."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            lines = []
+            for row in self.rows:
+                lines.append("\t".join("\\N" if value is None else str(value) for value in row))
+                if len(lines) == ROWS_PER_BLOCK:
+                    break
+            if not lines:
+                break
+            self.buffer += ("\n".join(lines) + "\n").encode()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        return self.read(65536)
+
+
+def users(count, rng):
+    start = date(1950, 1, 1)
+    for user_id in range(1, count + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield (
+            user_id,
+            first,
+            last,
+            f"{first.lower()}.{last.lower()}{user_id}@example.com",
+            start + timedelta(days=rng.randrange(20000)),
+        )
+
+
+def films(count, rng):
+    start = date(1920, 1, 1)
+    for film_id in range(1, count + 1):
+        yield (
+            film_id,
+            f"Film {film_id}",
+            start + timedelta(days=rng.randrange(38000)),
+            f"{rng.uniform(1, 30):.2f}",
+            rng.choice(RATINGS),
+            f"{rng.uniform(1, 5):.1f}",
+        )
+
+
+def film_categories(film_count, rng):
+    category_id = 0
+    for film_id in range(1, film_count + 1):
+        for name in rng.sample(CATEGORIES, CATEGORIES_PER_FILM):
+            category_id += 1
+            yield (category_id, film_id, name)
+
+
+def actors(count, rng):
+    for actor_id in range(1, count + 1):
+        yield (actor_id, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {actor_id}")
+
+
+def film_actors(film_count, actor_count, rng):
+    for film_id in range(1, film_count + 1):
+        # ^ distinct actors per film keep the (film_id, actor_id) primary key valid
+        for actor_id in rng.sample(range(1, actor_count + 1), min(ACTORS_PER_FILM, actor_count)):
+            yield (film_id, actor_id)
+
+
+def generate(config, scale, seed):
+    """Replace the contents of the users/films/film_category/actors/film_actors tables.
+
+    scale is the number of users and of films; actors are half that, and each film gets
+    CATEGORIES_PER_FILM categories and ACTORS_PER_FILM actors, so about 7.5 x scale rows
+    are written in total. The tables must already exist (init.sql creates them).
+    """
+    rng = random.Random(seed)
+    actor_count = max(1, scale // 2)
+    plan = [
+        ("users", "id, first_name, last_name, email, date_of_birth", users(scale, rng)),
+        ("films", "film_id, title, release_date, price, rating, user_rating", films(scale, rng)),
+        ("film_category", "category_id, film_id, category_name", film_categories(scale, rng)),
+        ("actors", "actor_id, actor_name", actors(actor_count, rng)),
+        ("film_actors", "film_id, actor_id", film_actors(scale, actor_count, rng)),
+    ]
+
+    connection = psycopg2.connect(**config)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "TRUNCATE users, films, film_category, actors, film_actors RESTART IDENTITY"
+            )
+            for table, columns, rows in plan:
+                started = time.monotonic()
+                cursor.copy_expert(
+                    f"COPY {table} ({columns}) FROM STDIN", RowStream(rows), size=COPY_READ_BYTES
+                )
+                print(f"Generated {cursor.rowcount} rows in {table} in {time.monotonic() - started:.2f}s")
+
+            # * Move the serial sequences past the generated ids so later inserts still work
+            for table, column in [
+                ("users", "id"),
+                ("films", "film_id"),
+                ("film_category", "category_id"),
+                ("actors", "actor_id"),
+            ]:
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'),"
+                    f" greatest((SELECT max({column}) FROM {table}), 1))"
+                )
+            cursor.execute("ANALYZE users, films, film_category, actors, film_actors")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill source_db with synthetic users, films and actors at a chosen scale."
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1000,
+        help="number of users and of films (about 7.5x this many rows in total)",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for repeatable data")
+    args = parser.parse_args()
+    generate(source_config, args.scale, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import psycopg2
+from psycopg2 import sql
+
+import copy_engine
+import pushdown
+import scheduler
+
+# * Watermarks live on the destination, next to the data they describe
+STATE_SCHEMA = "elt_state"
+WATERMARK_TABLE = "table_watermarks"
+
+
+def ensure_state_table(connection):
+    """Create the watermark state table on the destination if it is missing."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+                CREATE SCHEMA IF NOT EXISTS {schema};
+                CREATE TABLE IF NOT EXISTS {table} (
+                    table_schema TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    watermark_column TEXT NOT NULL,
+                    watermark TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (table_schema, table_name)
+                )
+                """
+            ).format(
+                schema=sql.Identifier(STATE_SCHEMA),
+                table=sql.Identifier(STATE_SCHEMA, WATERMARK_TABLE),
+            )
+        )
+    connection.commit()
+
+
+def serial_key_columns(connection):
+    """Map each (schema, table) to its primary key column when the key is a single integer."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT n.nspname, c.relname, min(a.attname)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY (con.conkey)
+            WHERE con.contype = 'p'
+              AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+            GROUP BY n.nspname, c.relname, con.conkey
+            HAVING array_length(con.conkey, 1) = 1
+            """
+        )
+        return {(schema, table): column for schema, table, column in cursor.fetchall()}
+
+
+def stored_watermarks(connection):
+    """Return {(schema, table): (column, watermark)} from the destination state table."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                "SELECT table_schema, table_name, watermark_column, watermark FROM {}"
+            ).format(sql.Identifier(STATE_SCHEMA, WATERMARK_TABLE))
+        )
+        rows = cursor.fetchall()
+    connection.commit()
+    return {(schema, table): (column, value) for schema, table, column, value in rows}
+
+
+def destination_has_schema(source_config, destination_config):
+    """True when every source table already exists on the destination."""
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    try:
+        tables = copy_engine.list_tables(source_connection)
+        with destination_connection.cursor() as cursor:
+            for schema, table in tables:
+                cursor.execute(
+                    "SELECT to_regclass(%s)", (sql.Identifier(schema, table).as_string(cursor),)
+                )
+                if cursor.fetchone()[0] is None:
+                    return False
+        return True
+    finally:
+        source_connection.close()
+        destination_connection.close()
+
+
+def copy_increment(source_connection, destination_connection, schema, table, column, watermark):
+    """Copy the rows past the watermark and store the new one in the same destination transaction."""
+    table_name = sql.Identifier(schema, table)
+    column_name = sql.Identifier(column)
+
+    if watermark is None:
+        # ^ No stored watermark (first run, a copy mode load, a changed --watermark-column):
+        # ^ rows already on the destination must not be copied again into its live key
+        with destination_connection.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT max({})::text FROM {}").format(column_name, table_name))
+            watermark = cursor.fetchone()[0]
+        if watermark is not None:
+            print(f"Seeding the {schema}.{table} watermark from the destination: {watermark}")
+
+    # ^ Rows are bounded by the new watermark, so rows above it come with the next run. It
+    # ^ only counts rows whose transactions ended before any transaction still open in
+    # ^ the snapshot began: a row such a transaction commits later (a serial id it drew,
+    # ^ a timestamp it wrote) would otherwise land below the watermark and never be copied.
+    # ! Values a transaction draws before its first write (now() at its start, a serial
+    # ! id in the statement that writes it) can still predate older committed rows
+    settled = sql.SQL(
+        "age(xmin) > age((pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+        " % 4294967296)::text::xid)"
+    )
+    past = None
+    if watermark is not None:
+        past = sql.SQL("{} > {}").format(column_name, sql.Literal(watermark))
+    query = sql.SQL("SELECT max({c})::text, (max({c}) FILTER (WHERE {s}))::text FROM {t}").format(
+        c=column_name, s=settled, t=table_name
+    )
+    if past is not None:
+        query += sql.SQL(" WHERE {}").format(past)
+    with source_connection.cursor() as cursor:
+        cursor.execute(query)
+        newest, new_watermark = cursor.fetchone()
+    if newest != new_watermark:
+        print(
+            f"Leaving the newest {schema}.{table} rows for the next run: transactions open "
+            "since before the snapshot may still commit rows below them"
+        )
+
+    if new_watermark is not None:
+        conditions = [sql.SQL("{} <= {}").format(column_name, sql.Literal(new_watermark))]
+        if past is not None:
+            conditions.append(past)
+        query = pushdown.select(schema, table, sql.SQL(" AND ").join(conditions))
+        rows, size = copy_engine.copy_table(
+            source_connection, destination_connection, schema, table, source_query=query
+        )
+    elif watermark is None:
+        return 0, 0  # ^ an empty table: there is no watermark to store yet
+    else:
+        # ^ Nothing new, but a watermark seeded from the destination is stored all the same
+        new_watermark, rows, size = watermark, 0, 0
+
+    with destination_connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+                INSERT INTO {} (table_schema, table_name, watermark_column, watermark)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (table_schema, table_name) DO UPDATE
+                SET watermark_column = EXCLUDED.watermark_column,
+                    watermark = EXCLUDED.watermark,
+                    updated_at = now()
+                """
+            ).format(sql.Identifier(STATE_SCHEMA, WATERMARK_TABLE)),
+            (schema, table, column, new_watermark),
+        )
+    return rows, size
+
+
+def refresh_table(source_connection, destination_connection, schema, table):
+    """Replace the whole destination table; used when a table has no usable watermark column."""
+    with destination_connection.cursor() as cursor:
+        cursor.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(schema, table)))
+    return copy_engine.copy_table(source_connection, destination_connection, schema, table)
+
+
+def transfer_increments(source_config, destination_config, watermark_columns=None, jobs=1):
+    """Copy only the rows added since the previous run, parents before the tables referencing them.
+
+    watermark_columns maps "table" or "schema.table" to a column (e.g. a timestamp) that
+    overrides the default single-column integer primary key.
+    """
+    watermark_columns = watermark_columns or {}
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    workers = copy_engine.WorkerConnections(
+        source_config, destination_config, copy_engine.export_snapshot(source_connection)
+    )
+    try:
+        ensure_state_table(destination_connection)
+
+        tables = copy_engine.list_tables(source_connection)
+        serial_keys = serial_key_columns(source_connection)
+        watermarks = stored_watermarks(destination_connection)
+
+        def load(table):
+            schema, name = table
+            column = watermark_columns.get(f"{schema}.{name}") or watermark_columns.get(name)
+            column = column or serial_keys.get(table)
+
+            if column is None:
+                # ! No serial key and no configured column (e.g. film_actors): reload it in full
+                print(f"No watermark column for {schema}.{name}, refreshing it in full")
+
+                def step():
+                    return refresh_table(*workers.get(), schema, name)
+
+            else:
+                stored_column, watermark = watermarks.get(table, (None, None))
+                if stored_column != column:
+                    watermark = None  # ^ first run, or the watermark column was changed
+
+                def step():
+                    return copy_increment(*workers.get(), schema, name, column, watermark)
+
+            copy_engine.run_with_retries(*workers.get(), f"{schema}.{name}", step)
+
+        # * Foreign keys are live on the destination here, so a table waits for its parents
+        scheduler.run_in_dependency_order(
+            tables,
+            copy_engine.foreign_key_parents(source_connection),
+            jobs,
+            load,
+            on_failure=workers.cancel,
+        )
+
+        copy_engine.sync_sequences(source_connection, destination_connection)
+        source_connection.commit()
+    finally:
+        workers.close()
+        source_connection.close()
+        destination_connection.close()
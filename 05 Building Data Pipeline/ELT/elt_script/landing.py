@@ -0,0 +1,195 @@
+import datetime
+import os
+import time
+
+import psycopg2
+
+import copy_engine
+import metrics
+import pushdown
+import scheduler
+import streaming
+import transforms
+
+# * Rows per Arrow record batch pulled off the source; also the Parquet row group size
+BATCH_ROWS = 65_536
+
+# * A table's run directory gets a new part file after this many rows
+MAX_ROWS_PER_FILE = 5_000_000
+
+# * Parquet codecs, and the level used when none is given
+CODECS = ["none", "snappy", "gzip", "lz4", "zstd"]
+DEFAULT_LEVELS = {"gzip": 1, "zstd": 3}
+
+# * PostgreSQL type OIDs with a native Arrow type; every other type lands as its text form
+INT2, INT4, INT8, OID = 21, 23, 20, 26
+FLOAT4, FLOAT8, NUMERIC = 700, 701, 1700
+BOOL, BYTEA, DATE, TIME, TIMESTAMP, TIMESTAMPTZ = 16, 17, 1082, 1083, 1114, 1184
+MAX_DECIMAL_PRECISION = 38
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+    except ImportError:
+        raise RuntimeError(
+            "the Parquet landing zone needs the pyarrow package (pip install pyarrow)"
+        ) from None
+    return pyarrow
+
+
+def arrow_type(pa, column):
+    """Arrow type for a psycopg2 cursor description column."""
+    simple = {
+        INT2: pa.int16(),
+        INT4: pa.int32(),
+        INT8: pa.int64(),
+        OID: pa.int64(),
+        FLOAT4: pa.float32(),
+        FLOAT8: pa.float64(),
+        BOOL: pa.bool_(),
+        BYTEA: pa.binary(),
+        DATE: pa.date32(),
+        TIME: pa.time64("us"),
+        TIMESTAMP: pa.timestamp("us"),
+        TIMESTAMPTZ: pa.timestamp("us", tz="UTC"),
+    }
+    if column.type_code in simple:
+        return simple[column.type_code]
+    # ^ numeric(p, s) fits a decimal; an unconstrained numeric has no fixed scale
+    precision = column.precision or 0
+    if column.type_code == NUMERIC and 0 < precision <= MAX_DECIMAL_PRECISION:
+        return pa.decimal128(column.precision, column.scale or 0)
+    return pa.string()
+
+
+def arrow_schema(pa, description):
+    return pa.schema([pa.field(column.name, arrow_type(pa, column)) for column in description])
+
+
+def record_batch(pa, schema, rows):
+    """Turn a batch of row tuples into an Arrow record batch, one column at a time."""
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_string(field.type):
+            values = [
+                value if value is None or isinstance(value, str) else streaming.copy_text(value)
+                for value in values
+            ]
+        elif pa.types.is_binary(field.type):
+            values = [None if value is None else bytes(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def run_label():
+    """Partition value naming this run's files, sortable as text."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def land_table(
+    connection, directory, schema, table, label, codec, partition_column=None, transform=None
+):
+    """Stream one table into Parquet files; returns (rows, bytes on disk).
+
+    Files go to <directory>/<schema>.<table>/run=<label>/, and below that into one Hive
+    style directory per value of partition_column when one is given. Rows arrive in
+    bounded batches (see streaming.BatchStream), so a table never has to fit in memory.
+    transform, if given, rewrites each Arrow record batch before it is written.
+    """
+    pa = require_pyarrow()
+    stream = streaming.BatchStream(connection, pushdown.select(schema, table), BATCH_ROWS)
+    try:
+        batches = iter(stream)
+        _, rows = next(batches)
+        arrow = arrow_schema(pa, stream.description)
+        counted = {"rows": 0}
+
+        def convert(rows):
+            counted["rows"] += len(rows)
+            batch = record_batch(pa, arrow, rows)
+            return batch if transform is None else transform(batch)
+
+        first = convert(rows)
+
+        def record_batches():
+            yield first
+            for _, rows in batches:
+                yield convert(rows)
+
+        partitioning = None
+        if partition_column is not None:
+            partitioning = pa.dataset.partitioning(
+                pa.schema([first.schema.field(partition_column)]), flavor="hive"
+            )
+        codec = None if codec == "none" else codec
+        file_format = pa.dataset.ParquetFileFormat()
+        written = []
+        pa.dataset.write_dataset(
+            pa.RecordBatchReader.from_batches(first.schema, record_batches()),
+            os.path.join(directory, f"{schema}.{table}", f"run={label}"),
+            format=file_format,
+            partitioning=partitioning,
+            basename_template="part-{i}.parquet",
+            file_options=file_format.make_write_options(
+                compression=codec, compression_level=DEFAULT_LEVELS.get(codec)
+            ),
+            max_rows_per_file=MAX_ROWS_PER_FILE,
+            max_rows_per_group=BATCH_ROWS,
+            # ^ A rerun with the same label replaces its files instead of mixing with them
+            existing_data_behavior="delete_matching",
+            file_visitor=lambda written_file: written.append(written_file.path),
+        )
+    finally:
+        stream.close()
+    return counted["rows"], sum(os.path.getsize(path) for path in written)
+
+
+def land_tables(source_config, directory, jobs=1, codec="zstd", partition_columns=None):
+    """Write every source table as Parquet on `jobs` threads; returns the run label.
+
+    All tables are read in one exported snapshot, like the COPY engine does.
+    partition_columns maps "table" or "schema.table" to a column to partition its files on.
+    """
+    partition_columns = partition_columns or {}
+    label = run_label()
+    source_connection = psycopg2.connect(**source_config)
+    try:
+        snapshot = copy_engine.export_snapshot(source_connection)
+        tables = copy_engine.list_tables(source_connection)
+
+        def land(table):
+            schema, name = table
+            started = time.monotonic()
+            connection = psycopg2.connect(**source_config)
+            try:
+                connection.set_session(isolation_level="REPEATABLE READ", readonly=True)
+                with connection.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+                column = partition_columns.get(f"{schema}.{name}") or partition_columns.get(name)
+                rows, size = land_table(
+                    connection,
+                    directory,
+                    schema,
+                    name,
+                    label,
+                    codec,
+                    column,
+                    transforms.batch_transform(schema, name),
+                )
+            finally:
+                connection.close()
+            elapsed = time.monotonic() - started
+            print(f"Landed {schema}.{name}: {rows} rows, {size} bytes of Parquet in {elapsed:.2f}s")
+            metrics.record_table(f"landing {schema}.{name}", rows, size, elapsed, 0)
+
+        # ^ Files have no foreign keys, so every table can be written at once
+        scheduler.run_in_dependency_order(tables, {}, jobs, land)
+        source_connection.commit()
+    finally:
+        source_connection.close()
+    print(f"Landing zone run {label} written to {directory}")
+    return label
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# * One run per process: the ELT script calls start_run() once and everything else records into it
+_lock = threading.Lock()
+_run = {"mode": None, "pipeline": None, "started": None, "stages": [], "tables": []}
+
+
+def start_run(mode, pipeline=None):
+    with _lock:
+        _run.update(mode=mode, pipeline=pipeline, started=time.time(), stages=[], tables=[])
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage; the stage is recorded as failed if its block raises."""
+    started = time.monotonic()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        with _lock:
+            _run["stages"].append(
+                {
+                    "stage": name,
+                    "seconds": round(time.monotonic() - started, 3),
+                    "succeeded": succeeded,
+                }
+            )
+
+
+def record_table(label, rows, size, seconds, retries):
+    """Record one table (or chunk) transfer; safe to call from worker threads."""
+    with _lock:
+        _run["tables"].append(
+            {
+                "table": label,
+                "rows": rows,
+                "bytes": size,
+                "seconds": round(seconds, 3),
+                "retries": retries,
+            }
+        )
+
+
+def report(succeeded):
+    with _lock:
+        return {
+            "mode": _run["mode"],
+            "pipeline": _run["pipeline"],
+            "started_at": _run["started"],
+            "seconds": round(time.time() - _run["started"], 3),
+            "succeeded": succeeded,
+            "stages": list(_run["stages"]),
+            "tables": list(_run["tables"]),
+        }
+
+
+def _write_atomically(path, text):
+    # ^ The node_exporter textfile collector may read at any moment, so never expose a half-written file
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as output:
+        output.write(text)
+    os.replace(temporary, path)
+
+
+def _labels(**labels):
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def prometheus_text(run):
+    """Render a run report in the Prometheus text exposition format."""
+    tables = run["tables"]
+    metrics = [
+        ("elt_run_success", "1 if the last run finished without error", [({}, int(run["succeeded"]))]),
+        ("elt_run_duration_seconds", "Wall time of the last run", [({}, run["seconds"])]),
+        ("elt_run_last_start_timestamp_seconds", "Start time of the last run", [({}, run["started_at"])]),
+        (
+            "elt_stage_duration_seconds",
+            "Wall time of each pipeline stage",
+            [({"stage": s["stage"]}, s["seconds"]) for s in run["stages"]],
+        ),
+        ("elt_table_rows", "Rows copied per table", [({"table": t["table"]}, t["rows"]) for t in tables]),
+        ("elt_table_bytes", "Bytes copied per table", [({"table": t["table"]}, t["bytes"]) for t in tables]),
+        (
+            "elt_table_duration_seconds",
+            "Wall time per table",
+            [({"table": t["table"]}, t["seconds"]) for t in tables],
+        ),
+        (
+            "elt_table_retries",
+            "Retries needed per table",
+            [({"table": t["table"]}, t["retries"]) for t in tables],
+        ),
+    ]
+    # ^ Several pipelines may share one textfile directory, so their series need telling apart
+    run_labels = {"mode": run["mode"]}
+    if run["pipeline"]:
+        run_labels["pipeline"] = run["pipeline"]
+    lines = []
+    for name, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(**run_labels, **labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_reports(succeeded, json_path=None, prometheus_path=None):
+    """Write the run report as JSON and/or as a Prometheus textfile-collector file."""
+    run = report(succeeded)
+    if json_path:
+        _write_atomically(json_path, json.dumps(run, indent=2) + "\n")
+    if prometheus_path:
+        _write_atomically(prometheus_path, prometheus_text(run))
+    return run
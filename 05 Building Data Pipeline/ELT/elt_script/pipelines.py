@@ -0,0 +1,177 @@
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import yaml
+
+import copy_engine
+import elt_script
+import pushdown
+import transforms
+
+# * Keys a pipeline entry (or the defaults block) may set
+PIPELINE_KEYS = {
+    "name", "source", "destination", "include", "exclude", "pushdown", "transforms", "settings"
+}
+
+# * What os.path.expandvars leaves behind when a variable is not set
+UNSET_VARIABLE = re.compile(r"\$(\w+|\{[^}]*\})")
+
+
+def _merge(defaults, entry):
+    """A pipeline entry on top of the defaults; nested mappings are merged one level deep."""
+    merged = dict(defaults)
+    for key, value in entry.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            value = dict(merged[key], **value)
+        merged[key] = value
+    return merged
+
+
+def load_config(path):
+    """Read a YAML pipeline file; returns (max_parallel or None, [pipeline dicts]).
+
+    Connection values may reference environment variables as $NAME or ${NAME}, so
+    passwords can stay out of the file; a reference to an unset variable is an error.
+    """
+    with open(path) as config_file:
+        config = yaml.safe_load(config_file) or {}
+    defaults = config.get("defaults") or {}
+    pipelines, names = [], set()
+    for entry in config.get("pipelines") or []:
+        pipeline = _merge(defaults, entry)
+        unknown = set(pipeline) - PIPELINE_KEYS
+        if unknown:
+            raise ValueError(f"unknown pipeline keys {sorted(unknown)} in {path}")
+        name = pipeline.get("name")
+        if not name or name in names or os.sep in name:
+            raise ValueError(f"every pipeline needs a unique name without {os.sep!r}, got {name!r}")
+        names.add(name)
+        for side in ("source", "destination"):
+            if not pipeline.get(side):
+                raise ValueError(f"pipeline {name} has no {side}")
+            pipeline[side] = {
+                key: os.path.expandvars(value) if isinstance(value, str) else value
+                for key, value in pipeline[side].items()
+            }
+            for key, value in pipeline[side].items():
+                unset = UNSET_VARIABLE.search(value) if isinstance(value, str) else None
+                if unset:
+                    raise ValueError(
+                        f"pipeline {name} {side} {key} references {unset.group(0)}, "
+                        "which is not set in the environment"
+                    )
+        pipelines.append(pipeline)
+    return config.get("max_parallel"), pipelines
+
+
+def settings_to_argv(settings):
+    """Turn {"chunk_rows": 1000, "fast_load": True} into elt_script command-line options."""
+    argv = []
+    for key, value in (settings or {}).items():
+        option = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            for item in value:
+                argv += [option, str(item)]
+        else:
+            argv += [option, str(value)]
+    return argv
+
+
+def run_pipeline(pipeline, work_directory):
+    """Run one pipeline in this (pool) process, in a directory and log file of its own."""
+    directory = os.path.join(work_directory, pipeline["name"])
+    os.makedirs(directory, exist_ok=True)
+    # ^ Dump files and reports use relative paths, so pipelines cannot overwrite each other's
+    os.chdir(directory)
+    log = open("elt.log", "a")
+    # ^ Redirect the file descriptors, so pg_dump and psql output lands in the log as well
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    # * Each pipeline owns its process, so it can point the module-level configs at its pair
+    for config, values in (
+        (elt_script.source_config, pipeline["source"]),
+        (elt_script.destination_config, pipeline["destination"]),
+    ):
+        config.clear()
+        config.update(values)
+    copy_engine.set_table_filter(pipeline.get("include") or (), pipeline.get("exclude") or ())
+    pushdown.set_pushdown(pipeline.get("pushdown"))
+    transforms.set_transforms(pipeline.get("transforms"))
+    try:
+        elt_script.main(settings_to_argv(pipeline.get("settings")), pipeline=pipeline["name"])
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log.close()
+
+
+def run_pipelines(pipelines, max_parallel, work_directory):
+    """Run the pipelines on a pool of max_parallel processes; returns the names of the failed ones.
+
+    Pipelines are independent, so one failing does not stop the others. A cdc pipeline
+    never finishes and keeps one pool process for itself.
+    """
+    work_directory = os.path.abspath(work_directory)
+    failed = []
+    # ^ spawn starts every worker from a clean interpreter instead of a copy of this one
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, max_parallel), mp_context=context) as pool:
+        started = time.monotonic()
+        futures = {
+            pool.submit(run_pipeline, pipeline, work_directory): pipeline["name"]
+            for pipeline in pipelines
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            log = os.path.join(work_directory, name, "elt.log")
+            try:
+                future.result()
+                print(f"Pipeline {name} succeeded after {time.monotonic() - started:.2f}s")
+            except (Exception, SystemExit) as e:
+                # ^ elt_script exits when a database never comes up
+                failed.append(name)
+                print(f"Pipeline {name} failed: {e!r} (see {log})")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run every source -> destination pipeline listed in a YAML file."
+    )
+    parser.add_argument("--config", default="pipelines.yaml", help="pipeline definitions")
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        help="pipelines running at once (default: max_parallel from the file, else 2)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        default="pipelines",
+        help="each pipeline runs in a subdirectory named after it, with its log and reports",
+    )
+    parser.add_argument("--only", nargs="+", help="run just these pipelines")
+    args = parser.parse_args()
+
+    max_parallel, pipelines = load_config(args.config)
+    if args.only:
+        pipelines = [pipeline for pipeline in pipelines if pipeline["name"] in args.only]
+    failed = run_pipelines(pipelines, args.max_parallel or max_parallel or 2, args.work_dir)
+    print(f"{len(pipelines) - len(failed)} of {len(pipelines)} pipelines succeeded")
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import json
+import re
+
+import psycopg2
+import yaml
+from psycopg2 import sql
+
+import copy_engine
+
+# * Per-table extraction settings, keyed by "schema.table" or the bare table name:
+# * {"columns": [...], "where": "<SQL condition>"}; either key may be left out
+PUSHDOWN = {}
+
+# * Column lists derived from a dbt manifest; a table's own PUSHDOWN entry wins over them
+DERIVED = {}
+
+# * Column lists once checked against the source catalog, keyed by (schema, table)
+RESOLVED = {}
+
+
+def set_pushdown(config):
+    for table, settings in (config or {}).items():
+        unknown = set(settings or {}) - {"columns", "where"}
+        if unknown:
+            raise ValueError(f"unknown pushdown keys {sorted(unknown)} for {table}")
+    PUSHDOWN.clear()
+    PUSHDOWN.update(config or {})
+    RESOLVED.clear()
+
+
+def set_derived(config):
+    DERIVED.clear()
+    DERIVED.update(config or {})
+    RESOLVED.clear()
+
+
+def load_file(path):
+    with open(path) as config_file:
+        return yaml.safe_load(config_file) or {}
+
+
+def settings_for(schema, table):
+    return (
+        PUSHDOWN.get(f"{schema}.{table}")
+        or PUSHDOWN.get(table)
+        or DERIVED.get(f"{schema}.{table}")
+        or {}
+    )
+
+
+def _catalog_columns(cursor, schema, table):
+    """(name, required) for each column in order; required columns cannot be left out."""
+    cursor.execute(
+        """
+        SELECT a.attname,
+               a.attnotnull AND NOT a.atthasdef
+               OR EXISTS (SELECT 1 FROM pg_constraint con
+                          WHERE con.conrelid = a.attrelid AND con.contype = 'p'
+                            AND a.attnum = ANY (con.conkey))
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass
+          AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+        ORDER BY a.attnum
+        """,
+        (sql.Identifier(schema, table).as_string(cursor),),
+    )
+    return cursor.fetchall()
+
+
+def resolve(source_config):
+    """Check the configured columns against the source and fix each table's column list.
+
+    Primary key columns and NOT NULL columns without a default are always extracted, so
+    the destination rows stay loadable and addressable; the other columns are left NULL.
+    """
+    RESOLVED.clear()
+    if not PUSHDOWN and not DERIVED:
+        return
+    connection = psycopg2.connect(**source_config)
+    try:
+        with connection.cursor() as cursor:
+            for schema, table in copy_engine.list_tables(connection):
+                settings = settings_for(schema, table)
+                if not settings:
+                    continue
+                # ^ A filter alone still gets a column list, which leaves out generated
+                # ^ columns like COPY of the whole table does
+                wanted = settings.get("columns")
+                catalog = _catalog_columns(cursor, schema, table)
+                missing = set(wanted or ()) - {name for name, _ in catalog}
+                if missing:
+                    raise ValueError(f"{schema}.{table} has no columns {sorted(missing)}")
+                RESOLVED[(schema, table)] = [
+                    name for name, required in catalog if not wanted or required or name in wanted
+                ]
+                skipped = len(catalog) - len(RESOLVED[(schema, table)])
+                if skipped:
+                    print(f"Extracting {schema}.{table} without {skipped} unused columns")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def columns_for(schema, table):
+    """The columns extracted from the table, or None when it has no pushdown settings."""
+    return RESOLVED.get((schema, table))
+
+
+def condition_for(schema, table):
+    where = settings_for(schema, table).get("where")
+    return sql.SQL("({})").format(sql.SQL(where)) if where else None
+
+
+def is_pushed_down(schema, table):
+    return columns_for(schema, table) is not None or condition_for(schema, table) is not None
+
+
+def select(schema, table, condition=None):
+    """SELECT of the table's extracted columns and rows, further limited by condition."""
+    columns = columns_for(schema, table)
+    if columns is None:
+        column_list = sql.SQL("*")
+    else:
+        column_list = sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+    query = sql.SQL("SELECT {} FROM {}").format(column_list, sql.Identifier(schema, table))
+    conditions = [part for part in (condition_for(schema, table), condition) if part is not None]
+    if conditions:
+        query += sql.SQL(" WHERE {}").format(sql.SQL(" AND ").join(conditions))
+    return query
+
+
+# * "select *" or "alias.*" in a model means it may use every column
+SELECT_STAR = re.compile(r"(\bselect|\.)\s*\*")
+
+
+def _mentions(code, name):
+    return re.search(r"\b" + re.escape(name.lower()) + r"\b", code) is not None
+
+
+def from_dbt_manifest(manifest_path, source_config):
+    """Derive per-table column lists from a compiled dbt manifest (target/manifest.json).
+
+    A source column is needed when its name appears as a word in the compiled SQL of a
+    model that mentions the table; a model selecting * from it needs every column. Names
+    shared between tables make this err on the side of extracting more. Tables no model
+    mentions are left whole.
+    """
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    models = [
+        (node.get("compiled_code") or node.get("raw_code") or "").lower()
+        for node in manifest.get("nodes", {}).values()
+        if node.get("resource_type") in ("model", "snapshot")
+    ]
+    config = {}
+    connection = psycopg2.connect(**source_config)
+    try:
+        with connection.cursor() as cursor:
+            for schema, table in copy_engine.list_tables(connection):
+                mentioning = [code for code in models if _mentions(code, table)]
+                if not mentioning or any(SELECT_STAR.search(code) for code in mentioning):
+                    continue
+                catalog = [name for name, _ in _catalog_columns(cursor, schema, table)]
+                used = [
+                    name for name in catalog if any(_mentions(code, name) for code in mentioning)
+                ]
+                config[f"{schema}.{table}"] = {"columns": used}
+        connection.commit()
+    finally:
+        connection.close()
+    return config
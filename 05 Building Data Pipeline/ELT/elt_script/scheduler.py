@@ -0,0 +1,91 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import aio
+
+
+def cycle_components(tables, waiting_on):
+    """Map each table on a foreign key cycle to the tables it shares a cycle with.
+
+    Kahn's algorithm leaves the tables that can never start: those on a cycle, and
+    those that merely depend on one. Only tables that reach each other through their
+    parents (one strongly connected component) are on a cycle together.
+    """
+    remaining = {table: set(table_parents) for table, table_parents in waiting_on.items()}
+    ready = [table for table, table_parents in remaining.items() if not table_parents]
+    while ready:
+        done = ready.pop()
+        del remaining[done]
+        for table, table_parents in remaining.items():
+            if done in table_parents:
+                table_parents.discard(done)
+                if not table_parents:
+                    ready.append(table)
+
+    reachable = {}
+    for table in remaining:
+        seen, stack = set(), list(remaining[table])
+        while stack:
+            parent = stack.pop()
+            if parent not in seen:
+                seen.add(parent)
+                stack.extend(remaining[parent])
+        reachable[table] = seen
+    components = {}
+    for table in remaining:
+        members = {other for other in reachable[table] if table in reachable[other]}
+        if members:
+            components[table] = members
+    return components
+
+
+def run_in_dependency_order(tables, parents, jobs, load_table, on_failure=None):
+    """Run load_table(table) for every table on up to `jobs` threads.
+
+    parents maps a table to the tables its foreign keys reference (see
+    copy_engine.foreign_key_parents). A table starts as soon as all of its own parents
+    have finished, not after the whole previous level, so a slow table only holds back
+    its dependants. An asyncio loop does the ordering; load_table runs on a thread pool
+    because psycopg2 cannot COPY on non-blocking connections.
+
+    The first failure cancels every table that has not started and calls on_failure()
+    (for example WorkerConnections.cancel, to abort the COPYs still running); the error
+    is re-raised once the running tables have stopped.
+    """
+    tables = set(tables)
+    waiting_on = {
+        table: {parent for parent in parents.get(table, ()) if parent in tables and parent != table}
+        for table in tables
+    }
+    components = cycle_components(tables, waiting_on)
+    for members in {frozenset(members) for members in components.values()}:
+        print(f"Foreign key cycle between {sorted(members)}, loading them together")
+    for table, members in components.items():
+        # ^ No order satisfies a cycle, so its tables only wait on parents outside it;
+        # ^ tables that merely depend on a cycle still wait for their parents on it
+        waiting_on[table] -= members
+
+    async def orchestrate(pool):
+        loop = asyncio.get_running_loop()
+        finished = {table: asyncio.Event() for table in tables}
+
+        async def load(table):
+            for parent in waiting_on[table]:
+                await finished[parent].wait()
+            await loop.run_in_executor(pool, load_table, table)
+            finished[table].set()
+
+        try:
+            await aio.gather_or_cancel([load(table) for table in sorted(tables)])
+        except BaseException:
+            # ! Cancelling a task does not stop its thread; on_failure has to interrupt it
+            if on_failure is not None:
+                on_failure()
+            raise
+
+    pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+        asyncio.run(orchestrate(pool))
+    finally:
+        # ^ Tables already running finish (or fail) before the error surfaces
+        pool.shutdown(wait=True)
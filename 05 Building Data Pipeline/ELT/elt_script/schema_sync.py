@@ -0,0 +1,233 @@
+import psycopg2
+from psycopg2 import sql
+
+import copy_engine
+import incremental
+
+FINGERPRINT_TABLE = "schema_fingerprints"
+
+
+def table_fingerprints(connection):
+    """Map each (schema, table) to an md5 of its columns, constraints and indexes, in one catalog query."""
+    with connection.cursor() as cursor:
+        # ^ An empty search_path makes the pg_get_* functions schema-qualify every name,
+        # ^ so the text (and the hash) does not depend on the session settings
+        cursor.execute("SELECT pg_catalog.set_config('search_path', '', true)")
+        cursor.execute(
+            """
+            SELECT n.nspname, c.relname, md5(concat_ws(E'\\n',
+                (SELECT string_agg(concat_ws(' ',
+                            quote_ident(a.attname),
+                            format_type(a.atttypid, a.atttypmod),
+                            CASE WHEN a.attnotnull THEN 'NOT NULL' END,
+                            pg_get_expr(d.adbin, d.adrelid),
+                            nullif(a.attidentity, ''),
+                            nullif(a.attgenerated, '')), ', ' ORDER BY a.attnum)
+                 FROM pg_attribute a
+                 LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+                 WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+                (SELECT string_agg(con.conname || ' ' || pg_get_constraintdef(con.oid), ', '
+                                   ORDER BY con.conname)
+                 FROM pg_constraint con
+                 WHERE con.conrelid = c.oid),
+                (SELECT string_agg(pg_get_indexdef(i.indexrelid), ', '
+                                   ORDER BY pg_get_indexdef(i.indexrelid))
+                 FROM pg_index i
+                 WHERE i.indrelid = c.oid)))
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind = 'r'
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema', %s)
+              AND n.nspname NOT LIKE 'pg_toast%%'
+            """,
+            (incremental.STATE_SCHEMA,),
+        )
+        rows = cursor.fetchall()
+    connection.commit()
+    return {
+        (schema, table): fingerprint
+        for schema, table, fingerprint in rows
+        if copy_engine.table_selected(schema, table)
+    }
+
+
+def ensure_fingerprint_table(connection):
+    """Create the fingerprint state table on the destination if it is missing."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL(
+                """
+                CREATE SCHEMA IF NOT EXISTS {schema};
+                CREATE TABLE IF NOT EXISTS {table} (
+                    table_schema TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (table_schema, table_name)
+                )
+                """
+            ).format(
+                schema=sql.Identifier(incremental.STATE_SCHEMA),
+                table=sql.Identifier(incremental.STATE_SCHEMA, FINGERPRINT_TABLE),
+            )
+        )
+    connection.commit()
+
+
+def stored_fingerprints(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("SELECT table_schema, table_name, fingerprint FROM {}").format(
+                sql.Identifier(incremental.STATE_SCHEMA, FINGERPRINT_TABLE)
+            )
+        )
+        rows = cursor.fetchall()
+    connection.commit()
+    return {(schema, table): fingerprint for schema, table, fingerprint in rows}
+
+
+def existing_tables(connection, tables):
+    """The subset of tables that exist on the connection's database."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT t FROM unnest(%s::text[]) t WHERE to_regclass(t) IS NOT NULL",
+            ([sql.Identifier(*table).as_string(cursor) for table in tables],),
+        )
+        names = {row[0] for row in cursor.fetchall()}
+        present = {table for table in tables if sql.Identifier(*table).as_string(cursor) in names}
+    connection.commit()
+    return present
+
+
+def plan(source_config, destination_config):
+    """Compare source fingerprints with the ones stored on the destination.
+
+    Returns (fingerprints, changed, present): the source fingerprints, the tables whose
+    DDL must be (re)applied, and the source tables that already exist on the destination.
+    A table whose foreign keys reference a changed table counts as changed as well,
+    because dropping the referenced table drops those foreign keys with it.
+    """
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    try:
+        fingerprints = table_fingerprints(source_connection)
+        parents = copy_engine.foreign_key_parents(source_connection)
+        ensure_fingerprint_table(destination_connection)
+        stored = stored_fingerprints(destination_connection)
+        present = existing_tables(destination_connection, list(fingerprints))
+    finally:
+        source_connection.close()
+        destination_connection.close()
+
+    changed = {
+        table
+        for table, fingerprint in fingerprints.items()
+        if table not in present or stored.get(table) != fingerprint
+    }
+    growing = True
+    while growing:
+        growing = False
+        for child, child_parents in parents.items():
+            if child in fingerprints and child not in changed and child_parents & changed:
+                changed.add(child)
+                growing = True
+    return fingerprints, changed, present
+
+
+def drop_tables(destination_config, tables):
+    """Drop tables whose definition changed so their DDL can be replayed, forgetting their watermarks."""
+    if not tables:
+        return
+    connection = psycopg2.connect(**destination_config)
+    try:
+        incremental.ensure_state_table(connection)
+        with connection.cursor() as cursor:
+            # ! CASCADE also drops views over these tables; they come back with a full DDL replay
+            cursor.execute(
+                sql.SQL("DROP TABLE IF EXISTS {} CASCADE").format(
+                    sql.SQL(", ").join(sql.Identifier(*table) for table in sorted(tables))
+                )
+            )
+            cursor.execute(
+                sql.SQL(
+                    "DELETE FROM {} WHERE (table_schema, table_name) IN (SELECT * FROM unnest(%s, %s))"
+                ).format(sql.Identifier(incremental.STATE_SCHEMA, incremental.WATERMARK_TABLE)),
+                ([schema for schema, _ in tables], [table for _, table in tables]),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def truncate_tables(destination_config, tables):
+    """Empty unchanged tables before a full reload.
+
+    Tables outside the set whose foreign keys reference it would make TRUNCATE fail;
+    they are emptied along with it, with a warning naming them.
+    """
+    if not tables:
+        return
+    connection = psycopg2.connect(**destination_config)
+    try:
+        with connection.cursor() as cursor:
+            names = [sql.Identifier(*table).as_string(cursor) for table in sorted(tables)]
+            cursor.execute(
+                """
+                SELECT DISTINCT con.conrelid::regclass::text
+                FROM pg_constraint con
+                WHERE con.contype = 'f'
+                  AND con.confrelid IN (SELECT unnest(%s::text[])::regclass)
+                  AND con.conrelid NOT IN (SELECT unnest(%s::text[])::regclass)
+                ORDER BY 1
+                """,
+                (names, names),
+            )
+            referencing = [row[0] for row in cursor.fetchall()]
+            cascade = sql.SQL("")
+            if referencing:
+                print(
+                    "WARNING: emptying {} as well, because their foreign keys reference "
+                    "tables being reloaded".format(", ".join(referencing))
+                )
+                cascade = sql.SQL(" CASCADE")
+            cursor.execute(
+                sql.SQL("TRUNCATE {}{}").format(
+                    sql.SQL(", ").join(sql.Identifier(*table) for table in sorted(tables)),
+                    cascade,
+                )
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def store_fingerprints(destination_config, fingerprints):
+    """Record the fingerprints once the destination schema matches them."""
+    connection = psycopg2.connect(**destination_config)
+    try:
+        ensure_fingerprint_table(connection)
+        with connection.cursor() as cursor:
+            for (schema, table), fingerprint in fingerprints.items():
+                cursor.execute(
+                    sql.SQL(
+                        """
+                        INSERT INTO {} (table_schema, table_name, fingerprint)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (table_schema, table_name) DO UPDATE
+                        SET fingerprint = EXCLUDED.fingerprint, updated_at = now()
+                        """
+                    ).format(sql.Identifier(incremental.STATE_SCHEMA, FINGERPRINT_TABLE)),
+                    (schema, table, fingerprint),
+                )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def dump_options(tables):
+    """pg_dump -t options selecting exactly these tables (and the sequences they own)."""
+    options = []
+    for schema, table in sorted(tables):
+        # ^ Double quotes make pg_dump match the names literally instead of as patterns
+        options += ["-t", '"{}"."{}"'.format(schema.replace('"', '""'), table.replace('"', '""'))]
+    return options
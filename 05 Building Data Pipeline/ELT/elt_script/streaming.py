@@ -0,0 +1,224 @@
+import datetime
+import itertools
+import queue
+import threading
+
+from psycopg2 import extensions, extras, sql
+
+import pushdown
+import verify
+
+# * At most this many fetched batches wait for the writer before the source side blocks
+MAX_QUEUED_BATCHES = 2
+
+# * Rows per server-side cursor fetch; 0 leaves the byte-level COPY path in copy_engine alone
+SETTINGS = {"batch_rows": 0}
+
+# * Batch size for tables that must stream anyway (they have transforms) while SETTINGS is 0
+DEFAULT_BATCH_ROWS = 10_000
+
+_cursor_names = itertools.count(1)
+
+
+def set_batch_rows(batch_rows):
+    """Route every table copy through Python in batches of batch_rows rows (0 turns it off)."""
+    SETTINGS["batch_rows"] = max(0, batch_rows or 0)
+
+
+class BatchStream:
+    """Iterates over (columns, rows) batches read from a named cursor on a background thread.
+
+    A named cursor makes the server hold the result and send batch_rows rows per FETCH,
+    and the queue between the threads holds at most MAX_QUEUED_BATCHES batches, so a
+    slow consumer stalls the reader instead of letting rows pile up. Whatever the table
+    size, at most MAX_QUEUED_BATCHES + 2 batches are in memory at once.
+    """
+
+    def __init__(self, connection, query, batch_rows, max_batches=MAX_QUEUED_BATCHES):
+        self.connection = connection
+        self.query = query
+        self.batch_rows = batch_rows
+        # ^ The cursor description (with type OIDs), set before the first batch is queued
+        self.description = None
+        self._queue = queue.Queue(max_batches)
+        self._aborted = threading.Event()
+        self._thread = threading.Thread(target=self._read, name="batch-stream")
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            # ! A named cursor lives inside the transaction the caller's connection is in
+            with self.connection.cursor(name=f"elt_stream_{next(_cursor_names)}") as cursor:
+                # ^ json stays text, so a JSON array is not mistaken for a PostgreSQL array
+                extras.register_default_json(cursor, loads=lambda value: value)
+                extras.register_default_jsonb(cursor, loads=lambda value: value)
+                cursor.execute(self.query)
+                first = True
+                while True:
+                    rows = cursor.fetchmany(self.batch_rows)
+                    # ^ The first batch always goes out, so an empty table still has columns
+                    if rows or first:
+                        self.description = cursor.description
+                        columns = [column.name for column in cursor.description]
+                        if not self._put((columns, rows)):
+                            return
+                        first = False
+                    if len(rows) < self.batch_rows:
+                        self._put(None)
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the reader (if the consumer gave up early) and wait for it."""
+        self._aborted.set()
+        self._thread.join()
+
+
+def copy_text(value):
+    """One value in COPY text format (before escaping)."""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+    if isinstance(value, datetime.timedelta):
+        return f"{value.days} days {value.seconds} seconds {value.microseconds} microseconds"
+    if isinstance(value, list):
+        return "{" + ",".join(array_element(element) for element in value) + "}"
+    if isinstance(value, extras.Range):
+        if value.isempty:
+            return "empty"
+        return "".join(
+            [
+                "[" if value.lower_inc else "(",
+                "" if value.lower is None else array_element(value.lower),
+                ",",
+                "" if value.upper is None else array_element(value.upper),
+                "]" if value.upper_inc else ")",
+            ]
+        )
+    return str(value)
+
+
+def array_element(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, list):
+        return copy_text(value)
+    return '"' + copy_text(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def escape(text):
+    return (
+        text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+def encode_rows(rows, encoding):
+    """A batch of rows as COPY text data."""
+    lines = []
+    for row in rows:
+        lines.append(
+            "\t".join("\\N" if value is None else escape(copy_text(value)) for value in row)
+        )
+    lines.append("")
+    return "\n".join(lines).encode(encoding) if rows else b""
+
+
+class CopyReader:
+    """File-like COPY FROM STDIN source that encodes one batch at a time, on demand."""
+
+    def __init__(self, first, batches, encoding):
+        self.bytes = 0
+        self._batches = itertools.chain([first], batches)
+        self._encoding = encoding
+        self._current = b""
+
+    def read(self, size=-1):
+        while not self._current:
+            batch = next(self._batches, None)
+            if batch is None:
+                return b""
+            self._current = encode_rows(batch, self._encoding)
+            self.bytes += len(self._current)
+        if size is None or size < 0:
+            data, self._current = self._current, b""
+        else:
+            data, self._current = self._current[:size], self._current[size:]
+        return data
+
+
+def source_select(connection, schema, table):
+    """The SELECT reading a table: its pushdown query, or all of its non-generated columns.
+
+    Like COPY of a whole table, it leaves out generated columns, which COPY FROM refuses.
+    """
+    if pushdown.is_pushed_down(schema, table):
+        return pushdown.select(schema, table)
+    columns = verify.table_columns(connection, schema, table)
+    return sql.SQL("SELECT {} FROM {}").format(
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+        sql.Identifier(schema, table),
+    )
+
+
+def stream_table(
+    source_connection,
+    destination_connection,
+    schema,
+    table,
+    source_query=None,
+    transform=None,
+    batch_rows=None,
+):
+    """Copy one table through Python in bounded batches; returns (rows, bytes written).
+
+    transform(description, rows) turns each batch into a (columns, rows) pair, where
+    description is the source cursor description and columns name the destination
+    columns the rows are written to (see transforms.row_transform).
+    """
+    if source_query is None:
+        source_query = source_select(source_connection, schema, table)
+    stream = BatchStream(source_connection, source_query, batch_rows or SETTINGS["batch_rows"])
+    try:
+        batches = iter(stream)
+        columns, rows = next(batches)
+        if transform is not None:
+            columns, rows = transform(stream.description, rows)
+
+        def rest():
+            for batch_columns, batch in batches:
+                if transform is not None:
+                    batch_columns, batch = transform(stream.description, batch)
+                if batch_columns != columns:
+                    raise ValueError(f"transform changed the columns of {schema}.{table} mid-table")
+                yield batch
+
+        reader = CopyReader(rows, rest(), extensions.encodings[destination_connection.encoding])
+        copy_in = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(schema, table),
+            sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+        )
+        with destination_connection.cursor() as cursor:
+            cursor.copy_expert(copy_in, reader)
+            return cursor.rowcount, reader.bytes
+    finally:
+        stream.close()
@@ -0,0 +1,368 @@
+import hashlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import errors, sql
+
+import chunking
+import copy_engine
+import fast_load
+import metrics
+import scheduler
+
+# * Staging copies and their indexes carry this prefix until they are swapped in
+SWAP_PREFIX = "_elt_swap_"
+
+# * The swap gives up on its locks after LOCK_TIMEOUT and tries again, so one long query
+# * delays the swap instead of every new reader queueing behind the waiting swap
+LOCK_TIMEOUT = "5s"
+SWAP_RETRIES = 5
+RETRY_DELAY_SECONDS = 2
+
+_IDENTIFIER = r'(?:"(?:[^"]|"")+"|[^\s".]+)'
+INDEX_PREFIX = re.compile(
+    rf"^(CREATE (?:UNIQUE )?INDEX ){_IDENTIFIER}( ON (?:ONLY )?){_IDENTIFIER}\.{_IDENTIFIER} "
+)
+
+
+def staging_name(name):
+    """Temporary name for a staged table, constraint or index; long names are hashed."""
+    candidate = SWAP_PREFIX + name
+    if len(candidate.encode()) <= 63:
+        return candidate
+    return SWAP_PREFIX + hashlib.md5(name.encode()).hexdigest()
+
+
+def create_staging(connection, schema, table):
+    """Create an empty UNLOGGED copy of the live table with its columns, defaults and checks."""
+    staged = sql.Identifier(schema, staging_name(table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(staged))
+        cursor.execute(
+            sql.SQL("CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING ALL EXCLUDING INDEXES)").format(
+                staged, sql.Identifier(schema, table)
+            )
+        )
+    connection.commit()
+
+
+def index_statements(connection, schema, table):
+    """Statements that rebuild the live table's keys and indexes on its staging copy.
+
+    Returns (statements, renames); renames lists (kind, schema, table, temporary name,
+    live name) for every constraint and index that takes over a live name at the swap.
+    """
+    live = sql.Identifier(schema, table)
+    staged = sql.Identifier(schema, staging_name(table))
+    with connection.cursor() as cursor:
+        # ^ An empty search_path makes pg_get_*def schema-qualify every name it prints
+        cursor.execute("SELECT pg_catalog.set_config('search_path', '', true)")
+        cursor.execute(
+            """
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x')
+            ORDER BY conname
+            """,
+            (live.as_string(cursor),),
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = %s::regclass
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid)
+            ORDER BY c.relname
+            """,
+            (live.as_string(cursor),),
+        )
+        indexes = cursor.fetchall()
+
+        statements, renames = [], []
+        for name, definition in constraints:
+            statements.append(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}")
+                .format(staged, sql.Identifier(staging_name(name)), sql.SQL(definition))
+                .as_string(cursor)
+            )
+            renames.append(("constraint", schema, table, staging_name(name), name))
+        for name, definition in indexes:
+            # ^ Same definition, pointed at the staging table under a temporary index name
+            index_name = sql.Identifier(staging_name(name)).as_string(cursor)
+            table_name = staged.as_string(cursor)
+            statements.append(
+                INDEX_PREFIX.sub(
+                    lambda match: f"{match.group(1)}{index_name}{match.group(2)}{table_name} ",
+                    definition,
+                    count=1,
+                )
+            )
+            renames.append(("index", schema, table, staging_name(name), name))
+    connection.commit()
+    return statements, renames
+
+
+def finish_staging(connection, schema, table):
+    """Make the staged rows durable, then build keys and indexes and collect statistics."""
+    staged = sql.Identifier(schema, staging_name(table))
+    statements, renames = index_statements(connection, schema, table)
+    with connection.cursor() as cursor:
+        cursor.execute("SET maintenance_work_mem = %s", (fast_load.MAINTENANCE_WORK_MEM,))
+        # ! The live table must survive a crash, so the staged copy is written to WAL once,
+        # ! in one sequential pass; indexes come after so SET LOGGED does not rebuild them
+        cursor.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(staged))
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(sql.SQL("ANALYZE {}").format(staged))
+    connection.commit()
+    return renames
+
+
+def _regclasses(cursor, tables):
+    return [sql.Identifier(*table).as_string(cursor) for table in tables]
+
+
+def dependent_objects(cursor, tables):
+    """Collect what dropping the live tables would take with them, as statements to replay.
+
+    Returns (sequence owners, identity sequences, replay statements, foreign keys); the
+    replay statements restore owners, grants, triggers and dependent views in order.
+    """
+    names = _regclasses(cursor, tables)
+    cursor.execute(
+        """
+        SELECT d.objid::regclass::text, n.nspname, c.relname, a.attname
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_class c ON c.oid = d.refobjid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.refobjid = ANY (%s::regclass[]) AND d.deptype = 'a'
+        """,
+        (names,),
+    )
+    owned_sequences = cursor.fetchall()
+    cursor.execute(
+        """
+        SELECT n.nspname, c.relname, a.attname, s.relname
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class s ON s.oid = pg_get_serial_sequence(a.attrelid::regclass::text, a.attname)::regclass
+        WHERE a.attrelid = ANY (%s::regclass[]) AND a.attidentity <> ''
+        """,
+        (names,),
+    )
+    identity_sequences = cursor.fetchall()
+
+    cursor.execute(
+        """
+        WITH RECURSIVE views (oid, depth) AS (
+            SELECT r.ev_class, 1
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.classid = 'pg_rewrite'::regclass
+              AND d.refobjid = ANY (%s::regclass[]) AND r.ev_class <> d.refobjid
+            UNION ALL
+            SELECT r.ev_class, v.depth + 1
+            FROM views v
+            JOIN pg_depend d ON d.refobjid = v.oid AND d.classid = 'pg_rewrite'::regclass
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE r.ev_class <> v.oid
+        )
+        SELECT format('CREATE %%s %%s AS %%s',
+                      CASE c.relkind WHEN 'm' THEN 'MATERIALIZED VIEW' ELSE 'VIEW' END,
+                      c.oid::regclass, pg_get_viewdef(c.oid)),
+               c.oid::regclass::text
+        FROM views v
+        JOIN pg_class c ON c.oid = v.oid
+        GROUP BY c.oid
+        ORDER BY max(v.depth), c.oid
+        """,
+        (names,),
+    )
+    views = cursor.fetchall()
+    relations = names + [name for _, name in views]
+    cursor.execute(
+        """
+        SELECT format('ALTER %%s %%s OWNER TO %%I',
+                      CASE c.relkind WHEN 'm' THEN 'MATERIALIZED VIEW' WHEN 'v' THEN 'VIEW' ELSE 'TABLE' END,
+                      c.oid::regclass, pg_get_userbyid(c.relowner))
+        FROM pg_class c
+        WHERE c.oid = ANY (%s::regclass[])
+        UNION ALL
+        SELECT format('GRANT %%s ON %%s TO %%s%%s', a.privilege_type, c.oid::regclass,
+                      CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+                      CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END)
+        FROM pg_class c, aclexplode(c.relacl) a
+        WHERE c.oid = ANY (%s::regclass[]) AND a.grantee <> c.relowner
+        """,
+        (relations, relations),
+    )
+    access = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT pg_get_triggerdef(oid) FROM pg_trigger"
+        " WHERE tgrelid = ANY (%s::regclass[]) AND NOT tgisinternal ORDER BY tgname",
+        (names,),
+    )
+    triggers = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f'
+          AND (conrelid = ANY (%s::regclass[]) OR confrelid = ANY (%s::regclass[]))
+        ORDER BY 1, 2
+        """,
+        (names, names),
+    )
+    foreign_keys = cursor.fetchall()
+
+    replay = [statement for statement, _ in views] + access + triggers
+    return owned_sequences, identity_sequences, replay, foreign_keys
+
+
+def swap_in(destination_config, tables, renames):
+    """Replace every live table with its staged copy in one transaction.
+
+    Foreign keys come back NOT VALID; returns the statements that validate them, which
+    can run after the swap without blocking readers.
+    """
+    connection = psycopg2.connect(**destination_config)
+    try:
+        for attempt in range(1, SWAP_RETRIES + 1):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL lock_timeout = %s", (LOCK_TIMEOUT,))
+                    cursor.execute("SELECT pg_catalog.set_config('search_path', '', true)")
+                    cursor.execute(
+                        sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(
+                            sql.SQL(", ").join(sql.Identifier(*table) for table in tables)
+                        )
+                    )
+                    owned_sequences, identity_sequences, replay, foreign_keys = dependent_objects(
+                        cursor, tables
+                    )
+
+                    # ^ Serial sequences move to the staged column so dropping the live table keeps them
+                    for sequence, schema, table, column in owned_sequences:
+                        cursor.execute(
+                            sql.SQL("ALTER SEQUENCE {} OWNED BY {}").format(
+                                sql.SQL(sequence),
+                                sql.Identifier(schema, staging_name(table), column),
+                            )
+                        )
+                    # ! CASCADE also drops foreign keys and views over these tables; both are replayed below
+                    cursor.execute(
+                        sql.SQL("DROP TABLE {} CASCADE").format(
+                            sql.SQL(", ").join(sql.Identifier(*table) for table in tables)
+                        )
+                    )
+                    for schema, table in tables:
+                        cursor.execute(
+                            sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                                sql.Identifier(schema, staging_name(table)), sql.Identifier(table)
+                            )
+                        )
+                    for kind, schema, table, temporary, name in renames:
+                        if kind == "constraint":
+                            cursor.execute(
+                                sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                                    sql.Identifier(schema, table),
+                                    sql.Identifier(temporary),
+                                    sql.Identifier(name),
+                                )
+                            )
+                        else:
+                            cursor.execute(
+                                sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                                    sql.Identifier(schema, temporary), sql.Identifier(name)
+                                )
+                            )
+                    # ^ Identity columns got fresh sequences from LIKE; give them the old names back
+                    for schema, table, column, sequence in identity_sequences:
+                        cursor.execute(
+                            "SELECT pg_get_serial_sequence(%s, %s)",
+                            (sql.Identifier(schema, table).as_string(cursor), column),
+                        )
+                        cursor.execute(
+                            sql.SQL("ALTER SEQUENCE {} RENAME TO {}").format(
+                                sql.SQL(cursor.fetchone()[0]), sql.Identifier(sequence)
+                            )
+                        )
+                    for statement in replay:
+                        cursor.execute(statement)
+                    for table, name, definition in foreign_keys:
+                        cursor.execute(
+                            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID").format(
+                                sql.SQL(table), sql.Identifier(name), sql.SQL(definition)
+                            )
+                        )
+                connection.commit()
+                break
+            except errors.LockNotAvailable:
+                connection.rollback()
+                print(f"Swap could not lock the live tables (attempt {attempt}/{SWAP_RETRIES})")
+                if attempt == SWAP_RETRIES:
+                    raise
+                time.sleep(RETRY_DELAY_SECONDS * attempt)
+        return [
+            sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}")
+            .format(sql.SQL(table), sql.Identifier(name))
+            .as_string(connection)
+            for table, name, _ in foreign_keys
+        ]
+    finally:
+        connection.close()
+
+
+def reload_and_swap(source_config, destination_config, jobs=1, chunk_rows=None):
+    """Load every source table into a staging copy next to the live one, then swap them all in.
+
+    Readers keep querying the old tables during the whole load and only wait for the
+    short swap transaction, after which they see every new table at once.
+    """
+    source_connection = psycopg2.connect(**source_config)
+    destination_connection = psycopg2.connect(**destination_config)
+    workers = copy_engine.WorkerConnections(
+        source_config, destination_config, copy_engine.export_snapshot(source_connection)
+    )
+    chunk_pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+    renames = []
+    try:
+        tables = copy_engine.list_tables(source_connection)
+
+        def stage(table):
+            schema, name = table
+            create_staging(workers.get()[1], schema, name)
+            chunking.copy_into_staging(
+                workers, chunk_pool, schema, name, staging_name(name), chunk_rows
+            )
+            renames.extend(finish_staging(workers.get()[1], schema, name))
+
+        with metrics.stage("stage_tables"):
+            # ^ Staging copies have no foreign keys, so every table can load at once
+            scheduler.run_in_dependency_order(
+                tables, {}, jobs, stage, on_failure=workers.cancel
+            )
+
+        with metrics.stage("swap"):
+            started = time.monotonic()
+            validations = swap_in(destination_config, tables, renames)
+        print(f"Swapped in {len(tables)} tables in {time.monotonic() - started:.2f}s")
+        # ^ After the swap, so identity sequences that came with the staging copies are set too
+        copy_engine.sync_sequences(source_connection, destination_connection)
+        source_connection.commit()
+    finally:
+        chunk_pool.shutdown()
+        workers.close()
+        source_connection.close()
+        destination_connection.close()
+
+    with metrics.stage("validate_foreign_keys"):
+        fast_load.run_statements(destination_config, validations, jobs)
+    print(f"Validated {len(validations)} foreign keys")
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from psycopg2 import extensions, sql
+
+import landing
+import streaming
+import transforms
+
+# * Where cached tables live, how much disk they may use, and how a change is detected;
+# * no directory means the cache is off
+SETTINGS = {"directory": None, "max_bytes": 1024 ** 3, "fingerprint": "xmin"}
+
+INDEX_FILE = "index.json"
+
+_lock = threading.Lock()
+
+
+def configure(directory, max_bytes=None, fingerprint=None):
+    SETTINGS["directory"] = directory
+    if max_bytes is not None:
+        SETTINGS["max_bytes"] = max_bytes
+    if fingerprint is not None:
+        SETTINGS["fingerprint"] = fingerprint
+
+
+def enabled():
+    return bool(SETTINGS["directory"])
+
+
+def fingerprints(connection, tables):
+    """Map each table to a change fingerprint.
+
+    "xmin" scans each table for its row count, newest xmin and relfilenode (which
+    TRUNCATE and VACUUM FULL replace). Call this before taking the snapshot the data
+    is read in, so a change can only ever make the fingerprint look older than the
+    data, which costs a re-extract and never serves stale rows.
+
+    "stats" reads the pg_stat_user_tables insert/update/delete counters plus the
+    relfilenode instead, without touching the tables. The counters only move when a
+    backend flushes its stats, which can be up to a minute after the commit: a change
+    committed in that window leaves the fingerprint as it was, and the cache serves
+    the stale rows.
+    """
+    result = {}
+    with connection.cursor() as cursor:
+        if SETTINGS["fingerprint"] == "xmin":
+            for schema, table in tables:
+                cursor.execute(
+                    sql.SQL(
+                        "SELECT count(*), max(xmin::text::bigint), pg_relation_filenode(%s) FROM {}"
+                    ).format(sql.Identifier(schema, table)),
+                    (sql.Identifier(schema, table).as_string(cursor),),
+                )
+                result[(schema, table)] = "xmin:{}:{}:{}".format(*cursor.fetchone())
+        else:
+            # ! Counters reach the view when a backend flushes its stats, up to a minute after
+            # ! a commit; a change committed in that window is served stale from the cache
+            cursor.execute(
+                """
+                SELECT t.schemaname, t.relname, t.n_tup_ins, t.n_tup_upd, t.n_tup_del,
+                       pg_relation_filenode(t.relid), d.stats_reset
+                FROM pg_stat_user_tables t
+                CROSS JOIN pg_stat_database d
+                WHERE d.datname = current_database()
+                """
+            )
+            wanted = set(tables)
+            for schema, table, *counters in cursor.fetchall():
+                if (schema, table) in wanted:
+                    result[(schema, table)] = "stats:" + ":".join(map(str, counters))
+    connection.commit()
+    return result
+
+
+def _source_key(connection, schema, table, query):
+    info = connection.info
+    # ^ The query names the columns and filter, so a different extract gets its own entry
+    return f"{info.host}:{info.port}/{info.dbname}/{schema}.{table} {query.as_string(connection)}"
+
+
+def _path(key):
+    name = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(SETTINGS["directory"], name + ".arrow")
+
+
+def _read_index():
+    try:
+        with open(os.path.join(SETTINGS["directory"], INDEX_FILE)) as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_index(index):
+    path = os.path.join(SETTINGS["directory"], INDEX_FILE)
+    with open(path + ".tmp", "w") as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def lookup(key, fingerprint):
+    """Path of the cached copy of key if it was taken at this fingerprint, else None."""
+    with _lock:
+        index = _read_index()
+        entry = index.get(key)
+        if entry is None or entry["fingerprint"] != fingerprint or not os.path.exists(_path(key)):
+            return None
+        entry["last_used"] = time.time()
+        _write_index(index)
+    return _path(key)
+
+
+def store(key, fingerprint, temporary_path):
+    """Move a freshly written file into the cache, then evict least recently used tables."""
+    with _lock:
+        os.replace(temporary_path, _path(key))
+        index = _read_index()
+        index[key] = {
+            "fingerprint": fingerprint,
+            "bytes": os.path.getsize(_path(key)),
+            "last_used": time.time(),
+        }
+        total = sum(entry["bytes"] for entry in index.values())
+        for victim in sorted(index, key=lambda name: index[name]["last_used"]):
+            if total <= SETTINGS["max_bytes"]:
+                break
+            if victim == key:
+                continue
+            total -= index.pop(victim)["bytes"]
+            # ^ A reader that still has the file mapped keeps its pages until it is done
+            if os.path.exists(_path(victim)):
+                os.remove(_path(victim))
+            print(f"Evicted {victim} from the table cache")
+        _write_index(index)
+    return _path(key)
+
+
+def extract(connection, query, path):
+    """Write the query's rows to an uncompressed Arrow IPC file, streamed in bounded batches."""
+    pa = landing.require_pyarrow()
+    stream = streaming.BatchStream(connection, query, landing.BATCH_ROWS)
+    try:
+        batches = iter(stream)
+        _, rows = next(batches)
+        arrow = landing.arrow_schema(pa, stream.description)
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, arrow) as writer:
+            writer.write_batch(landing.record_batch(pa, arrow, rows))
+            for _, rows in batches:
+                writer.write_batch(landing.record_batch(pa, arrow, rows))
+    finally:
+        stream.close()
+
+
+def _rows(batch):
+    return list(zip(*(column.to_pylist() for column in batch.columns)))
+
+
+def load(destination_connection, schema, table, path):
+    """COPY a cached Arrow file, through the table's transforms, into the destination table.
+
+    The cache holds the source rows as they are, so changing the transforms does not
+    invalidate it. Returns (rows, bytes).
+    """
+    pa = landing.require_pyarrow()
+    transform = transforms.batch_transform(schema, table)
+    # ^ Arrow IPC files map straight into memory: only the batch being loaded gets paged in
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+
+        def batches():
+            for index in range(reader.num_record_batches):
+                batch = reader.get_batch(index)
+                yield batch if transform is None else transform(batch)
+
+        remaining = batches()
+        first = next(remaining)
+        copy_in = sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(schema, table),
+            sql.SQL(", ").join(sql.Identifier(name) for name in first.schema.names),
+        )
+        copy_reader = streaming.CopyReader(
+            _rows(first),
+            (_rows(batch) for batch in remaining),
+            extensions.encodings[destination_connection.encoding],
+        )
+        with destination_connection.cursor() as cursor:
+            cursor.copy_expert(copy_in, copy_reader)
+            return cursor.rowcount, copy_reader.bytes
+
+
+def copy_table(source_connection, destination_connection, schema, table, fingerprint):
+    """copy_engine.copy_table through the cache: unchanged tables never touch the source.
+
+    A miss (or no fingerprint) extracts the table into the cache first and loads the
+    destination from the cached file.
+    """
+    query = streaming.source_select(source_connection, schema, table)
+    key = _source_key(source_connection, schema, table, query)
+    path = lookup(key, fingerprint) if fingerprint is not None else None
+    if path is not None:
+        rows, size = load(destination_connection, schema, table, path)
+        print(f"Served {schema}.{table} from the table cache")
+        return rows, size
+    os.makedirs(SETTINGS["directory"], exist_ok=True)
+    temporary_path = f"{_path(key)}.{threading.get_ident()}.tmp"
+    try:
+        extract(source_connection, query, temporary_path)
+        path = store(key, fingerprint, temporary_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return load(destination_connection, schema, table, path)
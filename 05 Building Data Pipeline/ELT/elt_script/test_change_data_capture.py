@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+
+import elt_script
+
+
+class SeedTest(unittest.TestCase):
+    """change_data_capture seeds the destination until a copy run has finished."""
+
+    def setUp(self):
+        # * Destination state the patched helpers read and the fake copy run changes
+        self.state = {"unfinished": None, "schema": False, "slot": False, "copies": 0}
+
+        def ensure_slot(config):
+            new, self.state["slot"] = not self.state["slot"], True
+            return new
+
+        def copy_transfer(jobs, fast=False):
+            self.state["copies"] += 1
+            self.state["unfinished"] = (self.state["copies"], False)
+            self.state["schema"] = True
+            if self.state["copies"] == 1:
+                raise RuntimeError("connection lost halfway through the seed")
+            self.state["unfinished"] = None
+
+        patches = [
+            mock.patch.object(elt_script.cdc, "ensure_slot", side_effect=ensure_slot),
+            mock.patch.object(
+                elt_script.checkpoints,
+                "unfinished_run",
+                side_effect=lambda config: self.state["unfinished"],
+            ),
+            mock.patch.object(
+                elt_script.incremental,
+                "destination_has_schema",
+                side_effect=lambda source, destination: self.state["schema"],
+            ),
+            mock.patch.object(elt_script, "copy_transfer", side_effect=copy_transfer),
+        ]
+        for patch in patches:
+            patch.start()
+        self.stream_changes = mock.patch.object(elt_script.cdc, "stream_changes").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_restart_resumes_a_failed_seed(self):
+        with self.assertRaises(RuntimeError):
+            elt_script.change_data_capture(100, 0, 1)
+        self.stream_changes.assert_not_called()
+
+        # ^ The slot survives the failed run, so only the unfinished checkpoint run tells
+        elt_script.change_data_capture(100, 0, 1)
+        self.assertEqual(self.state["copies"], 2)
+        self.assertIsNone(self.state["unfinished"])
+        self.stream_changes.assert_called_once()
+
+    def test_seeded_destination_is_not_copied_again(self):
+        self.state.update(schema=True, slot=True)
+        elt_script.change_data_capture(100, 0, 1)
+        self.assertEqual(self.state["copies"], 0)
+        self.stream_changes.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
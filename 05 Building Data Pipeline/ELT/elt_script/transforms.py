@@ -0,0 +1,216 @@
+import datetime
+import hashlib
+import os
+
+import psycopg2
+import yaml
+from psycopg2 import sql
+
+import landing
+
+# * Per-table transform steps, keyed by "schema.table" or the bare table name
+TRANSFORMS = {}
+
+# * Each step names its input column under one of these keys
+OPERATIONS = {"lower", "hash", "age_bucket", "map", "drop"}
+
+# * Default age bucket edges in years: under 18, 18-24, 25-34, 35-49, 50-64, 65 and over
+AGE_BOUNDS = [18, 25, 35, 50, 65]
+
+
+def set_transforms(config):
+    """Validate and install a {table: [step, ...]} mapping (e.g. from transforms.yaml)."""
+    for table, steps in (config or {}).items():
+        for step in steps:
+            operations = OPERATIONS & set(step)
+            if len(operations) != 1:
+                raise ValueError(
+                    f"every transform step of {table} needs exactly one of {sorted(OPERATIONS)}"
+                )
+            if "age_bucket" in step and not step.get("into"):
+                raise ValueError(f"age_bucket on {table} needs an into column for the bucket")
+            if "map" in step and not isinstance(step.get("values"), dict):
+                raise ValueError(f"map on {table} needs a values mapping")
+            # ^ Checked here too, so a missing salt stops the run before any table is copied
+            if step.get("salt_env") and step["salt_env"] not in os.environ:
+                raise ValueError(f"hash salt variable {step['salt_env']} of {table} is not set")
+    TRANSFORMS.clear()
+    TRANSFORMS.update(config or {})
+
+
+def load_file(path):
+    with open(path) as config_file:
+        return yaml.safe_load(config_file) or {}
+
+
+def steps_for(schema, table):
+    return TRANSFORMS.get(f"{schema}.{table}") or TRANSFORMS.get(table) or []
+
+
+def _operation(step):
+    (operation,) = OPERATIONS & set(step)
+    return operation, step[operation]
+
+
+def written_columns(schema, table):
+    """Columns the table's steps write (as text), in place or into new columns."""
+    columns = []
+    for step in steps_for(schema, table):
+        operation, column = _operation(step)
+        if operation != "drop":
+            output = step.get("into") or column
+            if output not in columns:
+                columns.append(output)
+    return columns
+
+
+def dropped_columns(schema, table):
+    steps = steps_for(schema, table)
+    return [column for operation, column in map(_operation, steps) if operation == "drop"]
+
+
+def touched_columns(schema, table):
+    """Every column whose destination contents differ from the source (for verification)."""
+    return set(dropped_columns(schema, table)) | set(written_columns(schema, table))
+
+
+def lower(pa, array, step):
+    return pa.compute.utf8_lower(array.cast(pa.string()))
+
+
+def hash_values(pa, array, step):
+    """Hex SHA-256 of each value, salted with step["salt"] or the variable step["salt_env"] names.
+
+    Arrow has no cryptographic hash kernel, so each distinct value is hashed once in
+    Python and spread back over the batch with vectorized index lookups.
+    """
+    array = array.cast(pa.string())
+    salt = str(step.get("salt", ""))
+    if step.get("salt_env"):
+        if step["salt_env"] not in os.environ:
+            raise ValueError(f"hash salt variable {step['salt_env']} is not set")
+        salt = os.environ[step["salt_env"]]
+    salt = salt.encode()
+    distinct = pa.compute.unique(array).drop_null()
+    digests = pa.array(
+        [hashlib.sha256(salt + value.encode()).hexdigest() for value in distinct.to_pylist()],
+        type=pa.string(),
+    )
+    return pa.compute.take(digests, pa.compute.index_in(array, value_set=distinct))
+
+
+def age_bucket(pa, array, step):
+    """Bucket labels like "25-34" for the age, on the run date, of each date in array."""
+    import numpy
+
+    bounds = list(step.get("bounds") or AGE_BOUNDS)
+    labels = [f"<{bounds[0]}"]
+    labels += [f"{low}-{high - 1}" for low, high in zip(bounds, bounds[1:])]
+    labels.append(f"{bounds[-1]}+")
+
+    today = datetime.date.today()
+    compute = pa.compute
+    years = compute.year(array).fill_null(0).to_numpy(zero_copy_only=False)
+    months = compute.month(array).fill_null(0).to_numpy(zero_copy_only=False)
+    days = compute.day(array).fill_null(0).to_numpy(zero_copy_only=False)
+    # ^ One year less until this year's birthday has passed
+    before_birthday = (months > today.month) | ((months == today.month) & (days > today.day))
+    ages = today.year - years - before_birthday
+    buckets = numpy.asarray(labels, dtype=object)[numpy.searchsorted(bounds, ages, side="right")]
+    return pa.array(buckets, type=pa.string(), mask=array.is_null().to_numpy(zero_copy_only=False))
+
+
+def map_values(pa, array, step):
+    """Replace the values listed in step["values"]; others stay, or become step["default"]."""
+    array = array.cast(pa.string())
+    keys = pa.array([str(key) for key in step["values"]], type=pa.string())
+    replacements = pa.array(
+        [None if value is None else str(value) for value in step["values"].values()],
+        type=pa.string(),
+    )
+    positions = pa.compute.index_in(array, value_set=keys)
+    mapped = pa.compute.take(replacements, positions)
+    found = pa.compute.is_valid(positions)
+    otherwise = array
+    if "default" in step:
+        default = step["default"]
+        default = pa.scalar(None if default is None else str(default), pa.string())
+        otherwise = pa.compute.if_else(array.is_null(), array, default)
+    return pa.compute.if_else(found, mapped, otherwise)
+
+
+FUNCTIONS = {"lower": lower, "hash": hash_values, "age_bucket": age_bucket, "map": map_values}
+
+
+def apply(steps, batch):
+    """Run the steps over an Arrow record batch, one whole column at a time."""
+    pa = landing.require_pyarrow()
+    columns = dict(zip(batch.schema.names, batch.columns))
+    for step in steps:
+        operation, column = _operation(step)
+        if column not in columns:
+            raise ValueError(f"transform {operation} refers to missing column {column!r}")
+        if operation == "drop":
+            del columns[column]
+        else:
+            columns[step.get("into") or column] = FUNCTIONS[operation](pa, columns[column], step)
+    return pa.RecordBatch.from_arrays(list(columns.values()), names=list(columns))
+
+
+def batch_transform(schema, table):
+    """A function transforming Arrow record batches of the table, or None if it has no steps."""
+    steps = steps_for(schema, table)
+    if not steps:
+        return None
+    return lambda batch: apply(steps, batch)
+
+
+def row_transform(schema, table):
+    """The table's steps as a streaming.stream_table transform, or None if it has no steps.
+
+    Rows go into an Arrow batch, through the vectorized steps, and back out as rows.
+    """
+    steps = steps_for(schema, table)
+    if not steps:
+        return None
+    pa = landing.require_pyarrow()
+
+    def transform(description, rows):
+        batch = apply(steps, landing.record_batch(pa, landing.arrow_schema(pa, description), rows))
+        return batch.schema.names, list(zip(*(column.to_pylist() for column in batch.columns)))
+
+    return transform
+
+
+def apply_schema(destination_config, tables):
+    """Give destination tables the shape their transforms produce.
+
+    Written columns become text (new ones are added) and dropped columns are dropped.
+    Every statement is idempotent, so this runs after each pre-data step.
+    """
+    connection = psycopg2.connect(**destination_config)
+    try:
+        with connection.cursor() as cursor:
+            for schema, table in tables:
+                name = sql.Identifier(schema, table)
+                for column in written_columns(schema, table):
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} text").format(
+                            name, sql.Identifier(column)
+                        )
+                    )
+                    # ^ varchar to text needs no rewrite; other types are converted once
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} ALTER COLUMN {} TYPE text USING {}::text").format(
+                            name, sql.Identifier(column), sql.Identifier(column)
+                        )
+                    )
+                for column in dropped_columns(schema, table):
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} DROP COLUMN IF EXISTS {}").format(
+                            name, sql.Identifier(column)
+                        )
+                    )
+        connection.commit()
+    finally:
+        connection.close()
@@ -0,0 +1,123 @@
+import asyncio
+
+import psycopg2
+from psycopg2 import sql
+
+import aio
+import chunking
+import copy_engine
+import pushdown
+import transforms
+
+# * Both sides render rows to text with identical settings, so equal rows hash equally
+SESSION_SETTINGS = [
+    ("DateStyle", "ISO, MDY"),
+    ("IntervalStyle", "postgres"),
+    ("TimeZone", "UTC"),
+    ("extra_float_digits", "3"),
+    ("bytea_output", "hex"),
+]
+
+
+def table_columns(connection, schema, table):
+    """Names of the table's columns in order, skipping dropped and generated ones."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT a.attname
+            FROM pg_attribute a
+            WHERE a.attrelid = %s::regclass
+              AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = ''
+            ORDER BY a.attnum
+            """,
+            (sql.Identifier(schema, table).as_string(cursor),),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def checksum_query(schema, table, columns, condition=None):
+    """Row count plus the sum of 64-bit row hashes; a sum does not depend on row order."""
+    query = sql.SQL(
+        "SELECT count(*), coalesce(sum(hashtextextended(ROW({})::text, 0)::numeric), 0) FROM {}"
+    ).format(
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+        sql.Identifier(schema, table),
+    )
+    if condition is not None:
+        query += sql.SQL(" WHERE {}").format(condition)
+    return query
+
+
+def verify_tables(source_config, destination_config, jobs=1, chunk_rows=1_000_000):
+    """Compare row counts and row-hash sums of every table, per primary key chunk, on both sides.
+
+    Every (chunk, side) aggregate runs as its own query on an asyncio loop, with at most
+    `jobs` queries in flight per database, so the source and destination scans overlap.
+    The first failing query cancels the rest. Returns a list of mismatch descriptions.
+    """
+    planner = psycopg2.connect(**source_config)
+    try:
+        tasks = []
+        for schema, table in copy_engine.list_tables(planner):
+            # ^ Columns rewritten in flight differ by design, and columns left out of the
+            # ^ extract stay empty; the rest must still match
+            touched = transforms.touched_columns(schema, table)
+            extracted = pushdown.columns_for(schema, table)
+            columns = [
+                name
+                for name in table_columns(planner, schema, table)
+                if name not in touched and (extracted is None or name in extracted)
+            ]
+            where = pushdown.condition_for(schema, table)
+            column, points = chunking.plan_chunks(planner, schema, table, chunk_rows)
+            conditions = chunking.chunk_conditions(column, points) if points else [None]
+            for number, condition in enumerate(conditions, start=1):
+                label = f"{schema}.{table}"
+                if len(conditions) > 1:
+                    label += f" chunk {number}/{len(conditions)}"
+                # ^ The source side only counts the rows the pushdown filter lets through
+                source_condition = condition
+                if where is not None:
+                    source_condition = where
+                    if condition is not None:
+                        source_condition = sql.SQL("{} AND {}").format(where, condition)
+                source_query = checksum_query(schema, table, columns, source_condition)
+                destination_query = checksum_query(schema, table, columns, condition)
+                tasks.append(
+                    (label, source_query.as_string(planner), destination_query.as_string(planner))
+                )
+    finally:
+        planner.close()
+
+    async def aggregate_all():
+        pools = [
+            aio.ConnectionPool(config, jobs, SESSION_SETTINGS)
+            for config in (source_config, destination_config)
+        ]
+        try:
+            await aio.gather_or_cancel([pool.open() for pool in pools])
+            rows = await aio.gather_or_cancel(
+                [
+                    pool.fetch(query)
+                    for _, *queries in tasks
+                    for pool, query in zip(pools, queries)
+                ]
+            )
+        finally:
+            for pool in pools:
+                pool.close()
+        return [row[0] for row in rows]
+
+    results = asyncio.run(aggregate_all())
+
+    mismatches = []
+    for index, (label, *_) in enumerate(tasks):
+        (source_rows, source_hash), (destination_rows, destination_hash) = results[2 * index:2 * index + 2]
+        if source_rows != destination_rows:
+            mismatches.append(f"{label}: {source_rows} rows on source, {destination_rows} on destination")
+        elif source_hash != destination_hash:
+            mismatches.append(f"{label}: same row count ({source_rows}) but different contents")
+    print(f"Verified {len(tasks)} chunks, {len(mismatches)} mismatched")
+    for mismatch in mismatches:
+        print(f"Mismatch in {mismatch}")
+    return mismatches